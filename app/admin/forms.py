@@ -16,7 +16,7 @@ from wtforms.validators import ValidationError, InputRequired
 from werkzeug.utils import secure_filename
 
 from app.models import Dataset
-from app.utils.datasets import validate_dataset, get_name_from_dataset
+from app.utils.datasets import ingest_dataset
 
 
 class AdminManageTaskForm(FlaskForm):
@@ -43,19 +43,28 @@ class AdminAddDatasetForm(FlaskForm):
             current_app.instance_path, current_app.config["TEMP_DIR"], filename
         )
 
-        field.data.save(temp_filename)
-        error = validate_dataset(temp_filename)
+        ingested, error = ingest_dataset(field.data.stream, temp_filename)
         if not error is None:
             os.unlink(temp_filename)
             raise ValidationError("Error validating dataset: %s" % error)
 
-        name = get_name_from_dataset(temp_filename)
-        dataset = Dataset.query.filter_by(name=name).first()
+        record = ingested.record
+        dataset = Dataset.query.filter_by(name=record.name).first()
         if dataset is not None:
             os.unlink(temp_filename)
             raise ValidationError(
-                "A dataset with the name '%s' already exists." % name
+                "A dataset with the name '%s' already exists." % record.name
             )
+        dataset = Dataset.query.filter_by(md5sum=record.md5sum).first()
+        if dataset is not None:
+            os.unlink(temp_filename)
+            raise ValidationError(
+                "This file was already added as dataset '%s'." % dataset.name
+            )
+
+        # keep the results for the view, so it doesn't have to read the file
+        # again
+        self.ingested = ingested
 
 
 class AdminManageDatasetsForm(FlaskForm):
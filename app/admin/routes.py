@@ -4,17 +4,19 @@
 # License: See LICENSE file
 # Copyright: 2020 (c) The Alan Turing Institute
 
-import csv
-import io
 import os
 import datetime
 
 from flask import (
+    Response,
     current_app,
     flash,
+    jsonify,
     redirect,
     render_template,
+    request,
     send_file,
+    stream_with_context,
     url_for,
 )
 
@@ -30,13 +32,24 @@ from app.admin.forms import (
     AdminManageUsersForm,
     AdminSelectDatasetForm,
 )
+from app.main.datasets import chart_urls, save_dataset_changes
 from app.models import User, Dataset, Task, Annotation
 from app.utils.datasets import (
-    get_name_from_dataset,
-    md5sum,
-    dataset_is_demo,
-    load_data_for_chart,
+    record_file_stat,
+    create_chart_payloads,
+    create_dataset_store,
+    remove_dataset_files,
 )
+from app.utils.export import (
+    EXPORT_FORMATS,
+    available_formats,
+    cached_export,
+    dataset_annotations,
+    iter_annotations_csv,
+)
+from app.utils.snapshot import current_snapshot_records
+from app.utils.tables import Column, ServerSideTable
+from app.utils.tasks import add_task, delete_task
 
 
 @bp.route("/manage/tasks", methods=("GET", "POST"))
@@ -83,7 +96,7 @@ def manage_tasks():
             else:
                 task = Task(annotator_id=user.id, dataset_id=dataset.id)
                 task.admin_assigned = True
-                db.session.add(task)
+                add_task(task)
                 db.session.commit()
                 flash("Task registered successfully.", "success")
         else:
@@ -92,21 +105,51 @@ def manage_tasks():
                 return redirect(url_for("admin.manage_tasks"))
             else:
                 # delete annotations too
-                for ann in Annotation.query.filter_by(task_id=task.id).all():
-                    db.session.delete(ann)
-                db.session.delete(task)
+                delete_task(task)
                 db.session.commit()
                 flash("Task deleted successfully.", "success")
 
-    tasks = (
-        Task.query.join(User, Task.user)
-        .join(Dataset, Task.dataset)
-        .order_by(Dataset.name, User.username)
-        .all()
-    )
     return render_template(
-        "admin/manage_tasks.html", title="Assign Task", form=form, tasks=tasks
+        "admin/manage_tasks.html", title="Assign Task", form=form
+    )
+
+
+@bp.route("/manage/tasks/table", methods=("GET",))
+@admin_required
+def tasks_table():
+    query = (
+        db.session.query(
+            Task.id,
+            Dataset.name,
+            User.username,
+            Task.done,
+            Task.annotated_on,
+            Task.id,
+        )
+        .select_from(Task)
+        .join(User, Task.user)
+        .join(Dataset, Task.dataset)
     )
+    columns = [
+        Column(Task.id, nullable=False, searchable=False),
+        Column(Dataset.name, nullable=False, searchable=True),
+        Column(User.username, nullable=False, searchable=True),
+        Column(Task.done, nullable=False, searchable=False),
+        Column(Task.annotated_on, nullable=True, searchable=False),
+    ]
+
+    def render(row):
+        task_id, dataset_name, username, done, annotated_on, _ = row
+        return [
+            task_id,
+            dataset_name,
+            username,
+            "Completed" if done else "Pending",
+            str(annotated_on) if done else "",
+        ]
+
+    table = ServerSideTable(query, columns, render)
+    return jsonify(table.response(request.args))
 
 
 @bp.route("/manage/users", methods=("GET", "POST"))
@@ -128,9 +171,7 @@ def manage_users():
 
         tasks = Task.query.filter_by(annotator_id=user.id).all()
         for task in tasks:
-            for ann in Annotation.query.filter_by(task_id=task.id).all():
-                db.session.delete(ann)
-            db.session.delete(task)
+            delete_task(task)
         db.session.delete(user)
         db.session.commit()
         flash("User '%s' deleted successfully." % username, "success")
@@ -164,13 +205,10 @@ def manage_datasets():
 
         tasks = Task.query.filter_by(dataset_id=dataset.id).all()
         for task in tasks:
-            for ann in Annotation.query.filter_by(task_id=task.id).all():
-                db.session.delete(ann)
-            db.session.delete(task)
+            delete_task(task)
         db.session.delete(dataset)
         db.session.commit()
-        if os.path.exists(filename):
-            os.unlink(filename)
+        remove_dataset_files(filename)
         flash("Dataset deleted successfully.", "success")
         return redirect(url_for("admin.manage_datasets"))
 
@@ -218,7 +256,8 @@ def add_dataset():
         if not os.path.exists(temp_filename):
             flash("Internal error: temporary dataset disappeared.", "error")
             return redirect(url_for("admin.add_dataset"))
-        name = get_name_from_dataset(temp_filename)
+        record = form.ingested.record
+        name = record.name
         target_filename = os.path.join(dataset_dir, name + ".json")
         if os.path.exists(target_filename):
             flash("Internal error: file already exists!", "error")
@@ -227,12 +266,28 @@ def add_dataset():
         if not os.path.exists(target_filename):
             flash("Internal error: file moving failed", "error")
             return redirect(url_for("admin.add_dataset"))
-        is_demo = dataset_is_demo(target_filename)
         dataset = Dataset(
-            name=name, md5sum=md5sum(target_filename), is_demo=is_demo
+            name=name,
+            md5sum=record.md5sum,
+            is_demo=record.is_demo,
+            n_obs=record.n_obs,
+            n_dim=record.n_dim,
         )
+        record_file_stat(dataset, os.stat(target_filename))
         db.session.add(dataset)
         db.session.commit()
+        create_dataset_store(
+            form.ingested.data,
+            dataset.md5sum,
+            target_filename,
+            columns=form.ingested.columns,
+        )
+        data = form.ingested.data
+        create_chart_payloads(
+            {"time": data.get("time"), "values": data["series"]},
+            dataset.md5sum,
+            target_filename,
+        )
         flash("Dataset %r added successfully." % name, "success")
         return redirect(url_for("admin.add_dataset"))
     return render_template("admin/add.html", title="Add Dataset", form=form)
@@ -254,104 +309,88 @@ def view_annotations():
             url_for("admin.view_annotations_by_dataset", dset_id=dataset.id)
         )
 
-    annotations = (
-        Annotation.query.join(Task, Annotation.task)
-        .join(User, Task.user)
-        .join(Dataset, Task.dataset)
-        .order_by(Dataset.name, User.username, Annotation.cp_index)
-        .all()
-    )
     return render_template(
         "admin/annotations.html",
         title="View Annotations",
-        annotations=annotations,
+        export_formats=available_formats(),
         form=form,
     )
 
 
-@bp.route("/annotations/download", methods=("GET",))
+@bp.route("/annotations/table", methods=("GET",))
 @admin_required
-def download_annotations_csv():
-    annotations = (
-        Annotation.query.join(Task, Annotation.task)
+def annotations_table():
+    query = (
+        db.session.query(
+            Dataset.name, User.username, Annotation.cp_index, Annotation.id
+        )
+        .select_from(Annotation)
+        .join(Task, Annotation.task)
         .join(User, Task.user)
         .join(Dataset, Task.dataset)
-        .order_by(Dataset.id, User.username, Annotation.cp_index)
-        .all()
     )
-
-    # based on: https://stackoverflow.com/a/45111660/1154005
-    header = [
-        "DatasetID",
-        "DatasetName",
-        "UserID",
-        "AnnotatedOn",
-        "AnnotationIndex",
+    columns = [
+        Column(Dataset.name, nullable=False, searchable=True),
+        Column(User.username, nullable=False, searchable=True),
+        Column(Annotation.cp_index, nullable=True, searchable=False),
     ]
 
-    proxy = io.StringIO()
-    writer = csv.writer(proxy)
-    writer.writerow(header)
-    for ann in annotations:
-        row = [
-            ann.task.dataset.id,
-            ann.task.dataset.name,
-            ann.task.user.id,
-            ann.task.annotated_on,
+    def render(row):
+        dataset_name, username, cp_index, _ = row
+        return [
+            dataset_name,
+            username,
+            "No CP" if cp_index is None else cp_index,
         ]
-        if ann.cp_index is None:
-            row.append("no_cp")
-        else:
-            row.append(ann.cp_index)
-        writer.writerow(row)
 
-    mem = io.BytesIO()
-    mem.write(proxy.getvalue().encode("utf-8"))
-    mem.seek(0)
-    proxy.close()
+    table = ServerSideTable(query, columns, render)
+    return jsonify(table.response(request.args))
 
-    fname = "%i_annotations.csv" % (round(datetime.datetime.now().timestamp()))
 
-    return send_file(
-        mem, as_attachment=True, attachment_filename=fname, mimetype="text/csv"
+@bp.route("/annotations/download", methods=("GET",))
+@admin_required
+def download_annotations_csv():
+    fmt = request.args.get("format", "csv")
+    if not fmt in available_formats():
+        flash("Export format %r is not available." % fmt, "error")
+        return redirect(url_for("admin.view_annotations"))
+
+    ext, mimetype = EXPORT_FORMATS[fmt]
+    fname = "%i_annotations.%s" % (
+        round(datetime.datetime.now().timestamp()),
+        ext,
     )
+    if fmt == "csv":
+        response = Response(
+            stream_with_context(iter_annotations_csv()), mimetype=mimetype
+        )
+    else:
+        filename = cached_export(fmt, records=current_snapshot_records)
+        response = send_file(filename, mimetype=mimetype)
+    response.headers["Content-Disposition"] = (
+        "attachment; filename=%s" % fname
+    )
+    return response
 
 
 @bp.route("/annotations_by_dataset/<int:dset_id>", methods=("GET",))
 @admin_required
 def view_annotations_by_dataset(dset_id):
     dataset = Dataset.query.filter_by(id=dset_id).first()
-    annotations = (
-        Annotation.query.join(Task, Annotation.task)
-        .join(User, Task.user)
-        .join(Dataset, Task.dataset)
-        .order_by(Dataset.name, User.username, Annotation.cp_index)
-        .all()
-    )
-
-    annotations = [a for a in annotations if a.task.dataset.id == dset_id]
+    if dataset is None:
+        flash("Dataset does not exist.", "error")
+        return redirect(url_for("admin.view_annotations"))
 
-    anno_clean = []
-    user_counter = {}
-    counter = 1
-    for ann in annotations:
-        if ann.task.user.id in user_counter:
-            uid = user_counter[ann.task.user.id]
-        else:
-            uid = user_counter.setdefault(
-                ann.task.user.id, "user-%i" % counter
-            )
-            counter += 1
-        anno_clean.append(dict(user=uid, index=ann.cp_index))
+    anno_clean = dataset_annotations(dset_id)
 
-    data = load_data_for_chart(dataset.name, dataset.md5sum)
-    is_multi = len(data["chart_data"]["values"]) > 1
-    data["annotations"] = anno_clean
+    chart = chart_urls(dataset)
+    save_dataset_changes(dataset)
     return render_template(
         "admin/annotations_by_dataset.html",
         title="View Annotations for dataset",
-        data=data,
-        is_multi=is_multi,
+        chart=chart,
+        annotations=anno_clean,
+        is_multi=chart["is_multi"],
     )
 
 
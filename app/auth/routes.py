@@ -34,7 +34,7 @@ from app.auth.email import (
     send_password_reset_email,
     send_email_confirmation_email,
 )
-from app.models import User, Task, Annotation
+from app.models import User
 
 
 LEGAL = markdown.markdown(
@@ -95,23 +95,6 @@ def login():
         current_user.last_active = datetime.datetime.utcnow()
         db.session.commit()
 
-        # remove any assigned unfinished datasets, as these may no longer be
-        # needed
-        user_tasks = Task.query.filter_by(
-            annotator_id=current_user.id, done=False
-        ).all()
-        for task in user_tasks:
-            if task.admin_assigned:
-                continue
-            anns = Annotation.query.filter_by(task_id=task.id).all()
-            if len(anns) > 0:
-                flash(
-                    "Internal error, unfinished tasks has annotations!",
-                    "error",
-                )
-            db.session.delete(task)
-            db.session.commit()
-
         # redirect if not confirmed yet
         if not user.is_confirmed:
             return redirect(url_for("auth.not_confirmed"))
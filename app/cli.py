@@ -5,12 +5,26 @@
 # Copyright: 2020 (c) The Alan Turing Institute
 
 import click
+import concurrent.futures
 import getpass
+import glob
+import os
+import shutil
 
 from email_validator import validate_email
+from flask import current_app
 
 from app import db
-from app.models import User
+from app.models import Dataset, User
+from app.utils.datasets import prepare_dataset_files, record_file_stat
+from app.utils.export import EXPORT_FORMATS, available_formats, write_export
+from app.utils.journal import replay_journal
+from app.utils.snapshot import (
+    compact_snapshot,
+    current_snapshot_records,
+    update_snapshot,
+)
+from app.utils.tasks import rebuild_task_counts, reap_expired_tasks
 
 
 def register(app):
@@ -43,3 +57,213 @@ def register(app):
         db.session.commit()
 
         print("Admin user %r added successfully." % username)
+
+    @admin.command("import-datasets")
+    @click.argument(
+        "directory", type=click.Path(exists=True, file_okay=False)
+    )
+    @click.option(
+        "-j",
+        "--jobs",
+        type=int,
+        default=None,
+        help="Number of worker processes (default: number of CPUs)",
+    )
+    def import_datasets(directory, jobs):
+        """Import all dataset (.json) files in a directory
+
+        Files are validated and hashed in parallel. Files that fail
+        validation, and datasets whose name or md5sum already exists, are
+        skipped. All new datasets are added in a single transaction.
+        """
+        filenames = sorted(glob.glob(os.path.join(directory, "*.json")))
+        if not filenames:
+            print("No dataset files found in %r." % directory)
+            return
+
+        dataset_dir = os.path.join(
+            current_app.instance_path, current_app.config["DATASET_DIR"]
+        )
+        staging_dir = os.path.join(
+            current_app.instance_path,
+            current_app.config["TEMP_DIR"],
+            "import-%i" % os.getpid(),
+        )
+        staging_dirs = [
+            os.path.join(staging_dir, str(i)) for i in range(len(filenames))
+        ]
+
+        known_names = set()
+        known_md5s = set()
+        for name, md5 in db.session.query(Dataset.name, Dataset.md5sum):
+            known_names.add(name)
+            known_md5s.add(md5)
+
+        failed = []
+        moved = []
+        try:
+            with concurrent.futures.ProcessPoolExecutor(jobs) as executor:
+                results = executor.map(
+                    prepare_dataset_files,
+                    filenames,
+                    staging_dirs,
+                    chunksize=16,
+                )
+                for filename, stage, (record, error) in zip(
+                    filenames, staging_dirs, results
+                ):
+                    if error is None and record.name in known_names:
+                        error = "Dataset %r already exists" % record.name
+                    if error is None and record.md5sum in known_md5s:
+                        error = "Dataset with this md5sum already exists"
+                    if error is None and os.path.exists(
+                        os.path.join(dataset_dir, record.name + ".json")
+                    ):
+                        error = "Dataset file already exists"
+                    if not error is None:
+                        failed.append((filename, error))
+                        continue
+                    known_names.add(record.name)
+                    known_md5s.add(record.md5sum)
+
+                    for fname in os.listdir(stage):
+                        target = os.path.join(dataset_dir, fname)
+                        os.replace(os.path.join(stage, fname), target)
+                        moved.append(target)
+                    target_filename = os.path.join(
+                        dataset_dir, record.name + ".json"
+                    )
+                    dataset = Dataset(
+                        name=record.name,
+                        md5sum=record.md5sum,
+                        is_demo=record.is_demo,
+                        n_obs=record.n_obs,
+                        n_dim=record.n_dim,
+                    )
+                    record_file_stat(dataset, os.stat(target_filename))
+                    db.session.add(dataset)
+            db.session.commit()
+        except:
+            db.session.rollback()
+            for fname in moved:
+                if os.path.exists(fname):
+                    os.unlink(fname)
+            raise
+        finally:
+            shutil.rmtree(staging_dir, ignore_errors=True)
+
+        for filename, error in failed:
+            print("Skipped %s: %s" % (filename, error))
+        print(
+            "Imported %i dataset(s), skipped %i."
+            % (len(filenames) - len(failed), len(failed))
+        )
+
+    @admin.command("rebuild-coverage")
+    def rebuild_coverage():
+        """Recompute the task counter of every dataset
+
+        The counters are kept up to date when tasks are created or deleted,
+        this command repairs them after tasks were changed outside the app.
+        """
+        n_stale = rebuild_task_counts()
+        db.session.commit()
+        print("Rebuilt task counters, %i dataset(s) were outdated." % n_stale)
+
+    @admin.command("reap-tasks")
+    def reap_tasks():
+        """Release unfinished tasks whose lease has expired
+
+        Run this periodically (e.g. from cron) so that datasets abandoned by
+        annotators become available again. Tasks assigned by an admin are
+        never released.
+        """
+        n_reaped = reap_expired_tasks()
+        db.session.commit()
+        print("Released %i expired task(s)." % n_reaped)
+
+    @admin.command("replay-journal")
+    @click.option(
+        "--verify",
+        is_flag=True,
+        help="Only report differences, don't change the database",
+    )
+    @click.option(
+        "--directory",
+        type=click.Path(exists=True, file_okay=False),
+        default=None,
+        help="Journal directory (default: JOURNAL_DIR in the instance path)",
+    )
+    def replay_journal_(verify, directory):
+        """Verify or restore annotations from the annotation journal
+
+        The most recent journal record of every user and dataset is
+        compared with the database. Without --verify, missing tasks and
+        tasks with different annotations are restored from the journal.
+        """
+        if directory is None:
+            directory = os.path.join(
+                current_app.instance_path, current_app.config["JOURNAL_DIR"]
+            )
+        stats, problems = replay_journal(directory, verify=verify)
+        for record, problem in problems:
+            print(
+                "%s: user %r, dataset %r (task %r)"
+                % (
+                    problem,
+                    record["user_id"],
+                    record["dataset_name"],
+                    record["task_id"],
+                )
+            )
+        print(
+            ", ".join("%s: %i" % (k, v) for k, v in sorted(stats.items()))
+            or "Journal is empty."
+        )
+        if verify and problems:
+            raise SystemExit(1)
+
+    @admin.command("export-annotations")
+    @click.argument("output", type=click.Path(dir_okay=False, writable=True))
+    @click.option(
+        "--format",
+        "fmt",
+        type=click.Choice(sorted(EXPORT_FORMATS)),
+        default=None,
+        help="Export format (default: from the extension of OUTPUT)",
+    )
+    def export_annotations(output, fmt):
+        """Export all annotations to a file
+
+        The CSV export has one row per annotation, the NDJSON and Parquet
+        exports have one row per task with a list of change points. Parquet
+        requires pyarrow. The per task exports are created from the export
+        snapshot, which is updated first.
+        """
+        if fmt is None:
+            fmt = os.path.splitext(output)[1].lstrip(".").lower()
+        if not fmt in available_formats():
+            raise click.UsageError("Export format %r is not available." % fmt)
+        records = None
+        if not fmt == "csv":
+            records = current_snapshot_records()
+        write_export(fmt, output, records=records)
+        print("Exported annotations to %s." % output)
+
+    @admin.command("update-snapshot")
+    @click.option(
+        "--compact",
+        is_flag=True,
+        help="Also drop replaced and deleted tasks from the snapshot",
+    )
+    def update_snapshot_(compact):
+        """Update the incremental export snapshot of the annotations
+
+        Only tasks annotated since the last update and tasks that were
+        deleted or restored in the meantime are queried.
+        """
+        n_lines = update_snapshot()
+        print("Appended %i line(s) to the export snapshot." % n_lines)
+        if compact:
+            n_removed = compact_snapshot()
+            print("Removed %i line(s) from the export snapshot." % n_removed)
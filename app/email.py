@@ -4,23 +4,210 @@
 # License: See LICENSE file
 # Copyright: 2020 (c) The Alan Turing Institute
 
-from threading import Thread
+"""Sending of email through a background worker
+
+Emails are put on a bounded queue that is processed by a single worker thread
+per process. The worker keeps one SMTP connection open while there is mail to
+send (and closes it after MAIL_IDLE_TIMEOUT seconds without mail), and retries
+failed messages MAIL_SEND_RETRIES times. When the queue is full, callers wait
+up to MAIL_QUEUE_TIMEOUT seconds before the message is dropped (and an error
+is logged).
+
+Records can also be collected into digest emails with send_digest_record.
+The worker sends a digest when MAIL_DIGEST_SIZE records have been collected,
+or MAIL_DIGEST_INTERVAL seconds after the first record came in.
+
+To try this locally, run an SMTP stand-in that prints all messages, for
+instance with 'python -m aiosmtpd -n -l localhost:2525' (or 'python -m smtpd
+-n -c DebuggingServer localhost:2525' on Python < 3.12), and set
+MAIL_SERVER=localhost and MAIL_PORT=2525.
+
+"""
+
+import atexit
+import logging
+import os
+import queue
+import threading
+import time
 
 from flask import current_app
 from flask_mail import Message
 
 from app import mail
 
+LOGGER = logging.getLogger(__name__)
+
+
+class MailWorker(object):
+    """Background thread that sends queued messages and digests
+
+    The worker is started lazily on first use and again after a fork (gunicorn
+    workers fork after the app is imported), as threads don't survive a fork.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._pid = None
+        self._queue = None
+        self._thread = None
+
+    def _ensure_started(self, app):
+        with self._lock:
+            if (
+                self._pid == os.getpid()
+                and not self._thread is None
+                and self._thread.is_alive()
+            ):
+                return
+            self._pid = os.getpid()
+            self._queue = queue.Queue(maxsize=app.config["MAIL_QUEUE_SIZE"])
+            self._thread = threading.Thread(
+                target=self._run, args=(app,), name="mail-worker", daemon=True
+            )
+            self._thread.start()
+
+    def put(self, kind, item):
+        """Queue a message or digest record, returns False if it was dropped"""
+        app = current_app._get_current_object()
+        self._ensure_started(app)
+        try:
+            self._queue.put(
+                (kind, item), timeout=app.config["MAIL_QUEUE_TIMEOUT"]
+            )
+        except queue.Full:
+            LOGGER.error("Mail queue is full, dropping %s." % kind)
+            return False
+        return True
+
+    def stop(self, timeout=10):
+        """Send everything that is queued and stop the worker"""
+        with self._lock:
+            if not self._pid == os.getpid() or self._thread is None:
+                return
+            thread = self._thread
+            self._thread = None
+        try:
+            self._queue.put(("stop", None), timeout=timeout)
+        except queue.Full:
+            return
+        thread.join(timeout)
+
+    def _run(self, app):
+        with app.app_context():
+            sender = _Sender(app)
+            digests = {}
+            while True:
+                timeout = _next_timeout(app, digests, sender)
+                try:
+                    kind, item = self._queue.get(timeout=timeout)
+                except queue.Empty:
+                    kind, item = None, None
+
+                if kind == "message":
+                    sender.send(item)
+                elif kind == "record":
+                    build_message, record = item
+                    started, records = digests.setdefault(
+                        build_message, (time.monotonic(), [])
+                    )
+                    records.append(record)
 
-def send_async_email(app, msg):
-    with app.app_context():
-        mail.send(msg)
+                stopping = kind == "stop"
+                for build_message in list(digests):
+                    started, records = digests[build_message]
+                    age = time.monotonic() - started
+                    if (
+                        stopping
+                        or len(records) >= app.config["MAIL_DIGEST_SIZE"]
+                        or age >= app.config["MAIL_DIGEST_INTERVAL"]
+                    ):
+                        del digests[build_message]
+                        try:
+                            msg = build_message(records)
+                        except Exception:
+                            LOGGER.exception("Failed to create digest email")
+                            continue
+                        sender.send(msg)
+
+                if stopping:
+                    sender.close()
+                    return
+                if kind is None and sender.is_idle():
+                    sender.close()
+
+
+class _Sender(object):
+    """ Sends messages over a reused SMTP connection, with retries """
+
+    def __init__(self, app):
+        self.app = app
+        self.connection = None
+        self.last_used = None
+
+    def is_idle(self):
+        if self.connection is None:
+            return False
+        idle = time.monotonic() - self.last_used
+        return idle >= self.app.config["MAIL_IDLE_TIMEOUT"]
+
+    def close(self):
+        if self.connection is None:
+            return
+        try:
+            self.connection.__exit__(None, None, None)
+        except Exception:
+            pass
+        self.connection = None
+
+    def send(self, msg):
+        retries = self.app.config["MAIL_SEND_RETRIES"]
+        for attempt in range(retries + 1):
+            try:
+                if self.connection is None:
+                    self.connection = mail.connect().__enter__()
+                self.connection.send(msg)
+                self.last_used = time.monotonic()
+                return True
+            except Exception as err:
+                self.close()
+                if attempt == retries:
+                    LOGGER.error(
+                        "Failed to send email %r after %i attempts: %s"
+                        % (msg.subject, retries + 1, err)
+                    )
+                    return False
+                time.sleep(2 ** attempt)
+
+
+def _next_timeout(app, digests, sender):
+    """ Time until the worker has to act without new queue items """
+    timeouts = []
+    if not sender.connection is None:
+        idle = time.monotonic() - sender.last_used
+        timeouts.append(max(0, app.config["MAIL_IDLE_TIMEOUT"] - idle))
+    for started, _ in digests.values():
+        age = time.monotonic() - started
+        timeouts.append(max(0, app.config["MAIL_DIGEST_INTERVAL"] - age))
+    return min(timeouts) if timeouts else None
+
+
+WORKER = MailWorker()
+atexit.register(WORKER.stop)
 
 
 def send_email(subject, sender, recipients, text_body, html_body):
     msg = Message(subject, sender=sender, recipients=recipients)
     msg.body = text_body
     msg.html = html_body
-    Thread(
-        target=send_async_email, args=(current_app._get_current_object(), msg)
-    ).start()
+    return WORKER.put("message", msg)
+
+
+def send_digest_record(build_message, record):
+    """Add a record to the digest email created by build_message
+
+    build_message is called in the worker (within an app context) with the
+    list of collected records and must return a Message. Records are grouped
+    by build_message, which should therefore be a module level function.
+    """
+    return WORKER.put("record", (build_message, record))
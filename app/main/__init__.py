@@ -8,6 +8,6 @@ from flask import Blueprint
 
 bp = Blueprint('main', __name__)
 
-from app.main import routes, demo
+from app.main import routes, demo, datasets
 
 
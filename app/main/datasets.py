@@ -4,13 +4,145 @@
 # License: See LICENSE file
 # Copyright: 2020 (c) The Alan Turing Institute
 
-import os
-import json
+"""Routes that serve dataset contents to the charts
+
+"""
+
+import gzip
 import logging
 
+from flask import (
+    abort,
+    current_app,
+    jsonify,
+    make_response,
+    request,
+    send_file,
+    url_for,
+)
+from flask_login import current_user
+
+from app import db
+from app.decorators import login_required
+from app.main import bp
+from app.models import Dataset, Task
+from app.utils.datasets import (
+    load_chart_payload,
+    load_dataset_shape,
+    load_tile_for_chart,
+)
+
+LOGGER = logging.getLogger(__name__)
+
+# upper limit on the width (in pixels) a client can request a tile for
+MAX_TILE_WIDTH = 4096
+
+
+def can_view_dataset(user, dataset):
+    """ Users can see demo datasets and datasets they have a task for """
+    if user.is_admin or dataset.is_demo:
+        return True
+    task = Task.query.filter_by(
+        annotator_id=user.id, dataset_id=dataset.id
+    ).first()
+    return not task is None
+
+
+def save_dataset_changes(dataset):
+    """Commit the file stat or shape recorded on a dataset while loading it
+
+    The loaders in app.utils.datasets don't commit, so that they never commit
+    anything else that happens to be in the session.
+    """
+    if db.session.is_modified(dataset):
+        db.session.commit()
+
+
+def chart_urls(dataset, use_tiles=False):
+    """URLs from which the chart loads the data of a dataset
+
+    Returns a dict with the 'data_url' to load initially, the 'tile_url' to 
+    load finer tiles from (None if the full series is loaded), and whether the 
+    dataset 'is_multi'. Tiles are only used with use_tiles for long univariate 
+    series. The shape of the dataset is taken from the database, for older 
+    datasets it is read from the dataset store and recorded (the caller 
+    commits). Returns None if the shape is unknown and the dataset can't be 
+    loaded.
+    """
+    if dataset.n_obs is None or dataset.n_dim is None:
+        shape = load_dataset_shape(dataset)
+        if shape is None:
+            return None
+        dataset.n_obs, dataset.n_dim = shape
+    n_obs, n_dim = dataset.n_obs, dataset.n_dim
+    max_points = current_app.config["CHART_MAX_POINTS"]
+    urls = {"data_url": None, "tile_url": None, "is_multi": n_dim > 1}
+    if use_tiles and n_dim == 1 and n_obs > max_points:
+        urls["tile_url"] = url_for("main.chart_tile", dataset_id=dataset.id)
+        urls["data_url"] = url_for(
+            "main.chart_tile", dataset_id=dataset.id, width=max_points // 2
+        )
+    else:
+        # the checksum in the URL allows browsers to cache the data forever
+        urls["data_url"] = url_for(
+            "main.chart_data", dataset_id=dataset.id, v=dataset.md5sum
+        )
+    return urls
+
+
+@bp.route("/data/<int:dataset_id>", methods=("GET",))
+@login_required
+def chart_data(dataset_id):
+    dataset = Dataset.query.filter_by(id=dataset_id).first()
+    if dataset is None or not can_view_dataset(current_user, dataset):
+        abort(404)
+
+    # The payloads are compressed when the dataset is added, we pick the best
+    # one the client accepts and send it as is. The payload only depends on
+    # the contents of the dataset file, which is identified by its md5sum.
+    gzip_filename = load_chart_payload(dataset, "gzip")
+    save_dataset_changes(dataset)
+    if gzip_filename is None:
+        abort(404)
+    encoding, filename = None, None
+    for enc in ["br", "gzip"]:
+        if enc in request.accept_encodings:
+            filename = load_chart_payload(dataset, enc)
+            if not filename is None:
+                encoding = enc
+                break
 
-from app.utils.datasets import md5sum
+    etag = dataset.md5sum + ("" if encoding is None else "-" + encoding)
+    if request.if_none_match.contains(etag):
+        response = make_response("", 304)
+    elif encoding is None:
+        with open(gzip_filename, "rb") as fid:
+            response = make_response(gzip.decompress(fid.read()))
+        response.mimetype = "application/json"
+    else:
+        response = send_file(filename, mimetype="application/json")
+        response.headers["Content-Encoding"] = encoding
+    response.set_etag(etag)
+    response.headers["Cache-Control"] = "private, max-age=31536000, immutable"
+    response.vary.add("Accept-Encoding")
+    return response
 
 
+@bp.route("/data/<int:dataset_id>/tile", methods=("GET",))
+@login_required
+def chart_tile(dataset_id):
+    dataset = Dataset.query.filter_by(id=dataset_id).first()
+    if dataset is None or not can_view_dataset(current_user, dataset):
+        abort(404)
 
+    start = request.args.get("start", 0, type=int)
+    end = request.args.get("end", None, type=int)
+    width = request.args.get("width", 1000, type=int)
+    width = min(max(width, 1), MAX_TILE_WIDTH)
 
+    data = load_tile_for_chart(dataset, start, end, width)
+    save_dataset_changes(dataset)
+    if data is None:
+        LOGGER.error("Failed to load tile for dataset %r" % dataset.name)
+        abort(404)
+    return jsonify(data["chart_data"])
@@ -4,7 +4,6 @@
 # License: See LICENSE file
 # Copyright: 2020 (c) The Alan Turing Institute
 
-import datetime
 import logging
 import markdown
 import textwrap
@@ -26,9 +25,11 @@ from app import db
 from app.decorators import login_required
 from app.models import Annotation, Dataset, Task
 from app.main import bp
+from app.main.datasets import chart_urls, save_dataset_changes
 from app.main.forms import NextForm
 from app.main.routes import RUBRIC
-from app.utils.datasets import load_data_for_chart, get_demo_true_cps
+from app.utils.datasets import get_demo_true_cps
+from app.utils.tasks import add_task, finish_task
 
 LOGGER = logging.getLogger(__name__)
 
@@ -436,26 +437,18 @@ def process_annotations(demo_id):
         name=DEMO_DATA[demo_id]["dataset"]["name"]
     ).first()
 
-    # Create a new task
-    task = Task(annotator_id=current_user.id, dataset_id=dataset.id)
-    task.done = False
-    task.annotated_on = None
-    db.session.add(task)
-    db.session.commit()
-    if annotation["changepoints"] is None:
-        ann = Annotation(cp_index=None, task_id=task.id)
-        db.session.add(ann)
-        db.session.commit()
-    else:
-        for cp in annotation["changepoints"]:
-            ann = Annotation(cp_index=cp["x"], task_id=task.id)
-            db.session.add(ann)
-            db.session.commit()
+    # Create a new task, or reuse the one from a previous attempt at the
+    # introduction (a user has at most one task per dataset).
+    task = Task.query.filter_by(
+        annotator_id=current_user.id, dataset_id=dataset.id
+    ).first()
+    if task is None:
+        task = Task(annotator_id=current_user.id, dataset_id=dataset.id)
+        add_task(task)
 
-    # mark task as done
-    task.done = True
-    task.annotated_on = datetime.datetime.utcnow()
-    db.session.commit()
+    # record the annotations and mark task as done
+    changepoints = None if annotation["changepoints"] is None else retval
+    finish_task(task, changepoints)
 
     return retval
 
@@ -543,15 +536,15 @@ def demo_annotate(demo_id):
         )
         return redirect(url_for("main.index"))
 
-    chart_data = load_data_for_chart(dataset.name, dataset.md5sum)
-    is_multi = len(chart_data["chart_data"]["values"]) > 1
+    chart = chart_urls(dataset)
+    save_dataset_changes(dataset)
     return render_template(
         "annotate/index.html",
         title="Introduction – %i" % demo_id,
-        data=chart_data,
+        chart=chart,
         rubric=demo_data["text"],
         identifier=demo_id,
-        is_multi=is_multi,
+        is_multi=chart["is_multi"],
     )
 
 
@@ -569,8 +562,8 @@ def demo_evaluate(demo_id, phase_id, form):
     dataset = Dataset.query.filter_by(
         name=DEMO_DATA[demo_id]["dataset"]["name"]
     ).first()
-    chart_data = load_data_for_chart(dataset.name, dataset.md5sum)
-    is_multi = len(chart_data["chart_data"]["values"]) > 1
+    chart = chart_urls(dataset)
+    save_dataset_changes(dataset)
     true_changepoints = get_demo_true_cps(dataset.name)
     if true_changepoints is None:
         flash(
@@ -586,13 +579,13 @@ def demo_evaluate(demo_id, phase_id, form):
     return render_template(
         "demo/evaluate.html",
         title="Introduction – %i" % demo_id,
-        data=chart_data,
+        chart=chart,
         annotations_user=annotations_user,
         annotations_true=annotations_true,
         text=demo_data["text"],
         feedback=feedback,
         form=form,
-        is_multi=is_multi,
+        is_multi=chart["is_multi"],
     )
 
 
@@ -7,23 +7,32 @@
 import json
 
 from flask import current_app, render_template
+from flask_mail import Message
 
-from app.email import send_email
+from app.email import send_digest_record
 
 
-def send_annotation_backup(record):
-    pretty_record = json.dumps(record, sort_keys=True, indent=4)
-    subject = "[Backup] New Annotation Recorded"
+def annotation_digest(records):
+    pretty_records = [json.dumps(r, sort_keys=True, indent=4) for r in records]
+    if len(records) == 1:
+        subject = "[Backup] New Annotation Recorded"
+    else:
+        subject = "[Backup] %i New Annotations Recorded" % len(records)
     if current_app.debug:
         subject += " (debug)"
-    send_email(
+    msg = Message(
         subject,
         sender=current_app.config["ADMINS"][0],
         recipients=[current_app.config["ADMINS"][0]],
-        text_body=render_template(
-            "email/annotation_record.txt", pretty_record=pretty_record
-        ),
-        html_body=render_template(
-            "email/annotation_record.html", pretty_record=pretty_record
-        ),
     )
+    msg.body = render_template(
+        "email/annotation_digest.txt", pretty_records=pretty_records
+    )
+    msg.html = render_template(
+        "email/annotation_digest.html", pretty_records=pretty_records
+    )
+    return msg
+
+
+def send_annotation_backup(record):
+    send_digest_record(annotation_digest, record)
@@ -7,16 +7,30 @@
 import datetime
 import logging
 
-from flask import render_template, flash, url_for, redirect, request
+from flask import (
+    current_app,
+    render_template,
+    flash,
+    url_for,
+    redirect,
+    request,
+)
 from flask_login import current_user
 
 from app import db
 from app.decorators import login_required
 from app.main import bp
+from app.main.datasets import chart_urls, save_dataset_changes
 from app.main.email import send_annotation_backup
-from app.models import Annotation, Task
-from app.utils.datasets import load_data_for_chart
-from app.utils.tasks import generate_user_task
+from app.models import Task
+from app.utils.journal import write_journal_record
+from app.utils.tasks import (
+    finish_task,
+    generate_user_task,
+    get_unfinished_task,
+    reap_expired_tasks,
+    renew_lease,
+)
 
 logger = logging.getLogger(__name__)
 
@@ -55,25 +69,26 @@ def index():
 def assign():
     # Intermediate page that assigns a task to a user if needed and then
     # redirects to /annotate/task.id
-    user_tasks = Task.query.filter_by(annotator_id=current_user.id).all()
-    user_tasks = [t for t in user_tasks if not t.dataset.is_demo]
-    user_tasks = [t for t in user_tasks if not t.done]
+    # release tasks that other users have abandoned
+    if reap_expired_tasks() > 0:
+        db.session.commit()
 
     # if the user has, for some reason, a unfinished assigned task, redirect to
     # that. This can happen if the admin has assigned this task.
-    if len(user_tasks) > 0:
-        task = user_tasks[0]
+    task = get_unfinished_task(current_user)
+    if not task is None:
         return redirect(url_for("main.annotate", task_id=task.id))
 
     task = generate_user_task(current_user)
+    if task is None:
+        # a concurrent request may have claimed a task for the user
+        task = get_unfinished_task(current_user)
     if task is None:
         flash(
             "There are no more datasets to annotate at the moment, thanks for all your help!",
             "info",
         )
         return redirect(url_for("main.index"))
-    db.session.add(task)
-    db.session.commit()
     return redirect(url_for("main.annotate", task_id=task.id))
 
 
@@ -92,39 +107,43 @@ def annotate(task_id):
 
         task = Task.query.filter_by(id=task_id).first()
 
-        # remove all previous annotations for this task
-        for ann in Annotation.query.filter_by(task_id=task_id).all():
-            db.session.delete(ann)
-        task.done = False
-        task.annotated_on = None
-        db.session.commit()
-
-        # record the annotation
-        if annotation["changepoints"] is None:
-            ann = Annotation(cp_index=None, task_id=task_id)
-            db.session.add(ann)
-            db.session.commit()
-        else:
-            for cp in annotation["changepoints"]:
-                ann = Annotation(cp_index=cp["x"], task_id=task_id)
-                db.session.add(ann)
-                db.session.commit()
-
-        # mark the task as done
-        task.done = True
-        task.annotated_on = now
-        db.session.commit()
+        # the task may have been released because its lease expired
+        if task is None or not task.annotator_id == current_user.id:
+            flash(
+                "This task is no longer assigned to you, your annotation "
+                "could not be recorded. Please try another dataset.",
+                "error",
+            )
+            return url_for("main.index")
+
+        # record the annotation and mark the task as done
+        changepoints = annotation["changepoints"]
+        if not changepoints is None:
+            changepoints = [int(cp["x"]) for cp in changepoints]
+        finish_task(task, changepoints, annotated_on=now)
         flash("Your annotation has been recorded, thank you!", "success")
 
-        # send the annotation as email to the admin for backup
+        # back up the annotation (by email to the admin and/or to the journal)
         record = {
             "user_id": task.annotator_id,
             "dataset_name": task.dataset.name,
             "dataset_id": task.dataset_id,
             "task_id": task.id,
+            "annotated_on": now.isoformat(),
             "annotations_raw": annotation,
         }
-        send_annotation_backup(record)
+        if "journal" in current_app.config["ANNOTATION_BACKUP"]:
+            write_journal_record(record)
+        if "email" in current_app.config["ANNOTATION_BACKUP"]:
+            send_annotation_backup(record)
+
+        # continue with the next task directly if enabled
+        if current_app.config["TASKS_PREASSIGN"]:
+            next_task = get_unfinished_task(current_user)
+            if next_task is None:
+                next_task = generate_user_task(current_user)
+            if not next_task is None:
+                return url_for("main.annotate", task_id=next_task.id)
         return url_for("main.index")
 
     task = Task.query.filter_by(id=task_id).first()
@@ -146,20 +165,24 @@ def annotate(task_id):
         flash("It's not possible to edit annotations at the moment.")
         return redirect(url_for("main.index"))
 
-    data = load_data_for_chart(task.dataset.name, task.dataset.md5sum)
-    if data is None:
+    # keep the task reserved while the user is working on it
+    renew_lease(task)
+    db.session.commit()
+
+    chart = chart_urls(task.dataset, use_tiles=True)
+    save_dataset_changes(task.dataset)
+    if chart is None:
         flash(
             "An internal error occurred loading this dataset, the admin has been notified. Please try again later. We apologise for the inconvenience.",
             "error",
         )
         return redirect(url_for("main.index"))
     title = f"Dataset: {task.dataset.id}"
-    is_multi = len(data["chart_data"]["values"]) > 1
     return render_template(
         "annotate/index.html",
         title=title,
         identifier=task.id,
-        data=data,
+        chart=chart,
         rubric=RUBRIC,
-        is_multi=is_multi,
+        is_multi=chart["is_multi"],
     )
@@ -96,18 +96,54 @@ class Dataset(db.Model):
     # Whether or not dataset is a demo dataset.
     is_demo = db.Column(db.Boolean(), default=True)
 
+    # Stat of the dataset file when its md5sum was last verified. As long as
+    # these don't change we don't need to hash the full file again.
+    file_size = db.Column(db.BigInteger, nullable=True)
+    file_mtime = db.Column(db.BigInteger, nullable=True)
+    file_inode = db.Column(db.BigInteger, nullable=True)
+    verified_on = db.Column(db.DateTime, nullable=True)
+
+    # Shape of the dataset, so that pages can be set up for the chart without
+    # opening the dataset files. NULL for datasets added before these were
+    # recorded, these are filled in when the dataset is first loaded.
+    n_obs = db.Column(db.Integer, nullable=True)
+    n_dim = db.Column(db.Integer, nullable=True)
+
+    # Number of tasks for this dataset. This is maintained by the task helpers
+    # in app.utils.tasks, so that task assignment doesn't need to count the
+    # tasks of every dataset. Use 'flask admin rebuild-coverage' to recompute.
+    n_tasks = db.Column(
+        db.Integer, nullable=False, default=0, server_default="0", index=True
+    )
+
     def __repr__(self):
         return "<Dataset %r>" % self.name
 
 
 class Task(db.Model):
+    __table_args__ = (
+        # a user is never given the same dataset twice
+        db.Index(
+            "ix_task_annotator_id_dataset_id",
+            "annotator_id",
+            "dataset_id",
+            unique=True,
+        ),
+        db.Index("ix_task_annotator_id_done", "annotator_id", "done"),
+        db.Index("ix_task_dataset_id_done", "dataset_id", "done"),
+    )
+
     id = db.Column(db.Integer, primary_key=True)
     annotator_id = db.Column(db.Integer, nullable=False)
     dataset_id = db.Column(db.Integer, nullable=False)
     done = db.Column(db.Boolean, nullable=False, default=False)
-    annotated_on = db.Column(db.DateTime, nullable=True)
+    annotated_on = db.Column(db.DateTime, nullable=True, index=True)
     admin_assigned = db.Column(db.Boolean, default=False)
 
+    # Unfinished tasks that weren't assigned by an admin are released after
+    # their lease expires (see app.utils.tasks.reap_expired_tasks).
+    lease_expires = db.Column(db.DateTime, nullable=True, index=True)
+
     user = db.relation("User")
     annotator_id = db.Column(db.Integer, db.ForeignKey("user.id"))
 
@@ -123,12 +159,28 @@ class Annotation(db.Model):
     cp_index = db.Column(db.Integer)
 
     task = db.relation("Task")
-    task_id = db.Column(db.Integer, db.ForeignKey("task.id"))
+    task_id = db.Column(db.Integer, db.ForeignKey("task.id"), index=True)
 
     def __repr__(self):
         return "<Annotation %r>" % self.id
 
 
+class TaskEvent(db.Model):
+    # Log of changes to finished tasks that aren't visible from their
+    # annotated_on, used to update the export snapshot (see
+    # app.utils.snapshot). The task_id is not a foreign key, as the task may
+    # no longer exist.
+    id = db.Column(db.Integer, primary_key=True)
+    task_id = db.Column(db.Integer, nullable=False)
+    event = db.Column(db.String(16), nullable=False)
+    created = db.Column(
+        db.DateTime, nullable=False, default=datetime.datetime.utcnow
+    )
+
+    def __repr__(self):
+        return "<TaskEvent %r (%r, %r)>" % (self.id, self.event, self.task_id)
+
+
 @login.user_loader
 def load_user(_id):
     return User.query.get(int(_id))
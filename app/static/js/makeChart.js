@@ -7,8 +7,11 @@ function preprocessData(data) {
 	run = [];
 	for (i=0; i<data.values[0].raw.length; i++) {
 		d = data.values[0].raw[i];
-		if (isNaN(d)) {
-			n++; // keep counting!
+		// Downsampled data (see DatasetStore.tile) has the original index of 
+		// every point in data.index.
+		x = data.index ? data.index[i] : n;
+		n++; // keep counting!
+		if (d === null || isNaN(d)) {
 			if (run.length > 0)
 				cleanData.push(run);
 			run = [];
@@ -18,13 +21,30 @@ function preprocessData(data) {
 		// change point index is ultimately retrieved from this X 
 		// value and the Python code is 0-based as well. Thus, the 
 		// first item should get X = 0.
-		run.push({"X": n++, "Y": d});
+		run.push({"X": x, "Y": d});
 	}
 	cleanData.push(run);
 	return cleanData;
 }
 
-function scaleAndAxis(data, width, height) {
+function mergeSelected(tile, selected) {
+	// Add the selected points that are not in the tile, so that they are 
+	// not lost when the view is replaced.
+	var inTile = new Set(tile.index);
+	var points = [];
+	for (i=0; i<tile.index.length; i++)
+		points.push({"X": tile.index[i], "Y": tile.values[0].raw[i]});
+	Object.values(selected).forEach(function(d) {
+		if (!inTile.has(d.X))
+			points.push({"X": d.X, "Y": d.Y});
+	});
+	points.sort(function(a, b) { return a.X - b.X; });
+	tile.index = points.map(d => d.X);
+	tile.values[0].raw = points.map(d => d.Y);
+	return tile;
+}
+
+function scaleAndAxis(data, width, height, nObs) {
 	// xScale is the active scale used for zooming, xScaleOrig is used as 
 	// the original scale that is never changed.
 	var xScale = d3.scaleLinear().range([0, width]);
@@ -39,10 +59,17 @@ function scaleAndAxis(data, width, height) {
 	// influenced by whether a change is big in the absolute sense.
 	yAxis.ticks(0);
 
-	var xmin = Math.min(...data.map(function(run) { return Math.min(...run.map(it => it.X)); }))
-	var xmax = Math.max(...data.map(function(run) { return Math.max(...run.map(it => it.X)); }))
-	var ymin = Math.min(...data.map(function(run) { return Math.min(...run.map(it => it.Y)); }))
-	var ymax = Math.max(...data.map(function(run) { return Math.max(...run.map(it => it.Y)); }))
+	// NOTE: don't use Math.min(...array) here, spreading fails for long 
+	// series.
+	var xmin = d3.min(data, function(run) { return d3.min(run, it => it.X); });
+	var xmax = d3.max(data, function(run) { return d3.max(run, it => it.X); });
+	var ymin = d3.min(data, function(run) { return d3.min(run, it => it.Y); });
+	var ymax = d3.max(data, function(run) { return d3.max(run, it => it.Y); });
+	// when showing a downsampled tile, the axis covers the full series
+	if (nObs !== null && typeof nObs !== 'undefined') {
+		xmin = 0;
+		xmax = nObs - 1;
+	}
 	var xExtent = [xmin, xmax];
 	var yExtent = [ymin, ymax];
 
@@ -77,7 +104,8 @@ function baseChart(
 	annotations,
 	annotationFunction,
 	divWidth,
-	divHeight
+	divHeight,
+	tileUrl
 ) {
 	/* Note:
 	 * It may be tempting to scale the width/height of the div to be 
@@ -91,8 +119,11 @@ function baseChart(
 		divWidth = 1000;
 	if (divHeight === null || typeof divHeight === 'undefined')
 		divHeight = 480;
+	if (typeof tileUrl === 'undefined')
+		tileUrl = null;
 
 	// preprocess the data
+	var nObs = data.n_obs;
 	data = preprocessData(data);
 
 	var svg = d3.select(selector)
@@ -110,32 +141,35 @@ function baseChart(
 	var [xAxis, yAxis, xScale, xScaleOrig, yScale, yDomainMin, yDomainMax] = scaleAndAxis(
 		data,
 		width,
-		height);
-
-	var lineObjects = [];
-	for (let r=0; r<data.length; r++) {
-		var lineObj = new d3.line()
-			.x(function(d) { return xScale(d.X); })
-			.y(function(d) { return yScale(d.Y); });
-		lineObjects.push(lineObj);
-	}
-
-	// Initialise the zoom behaviour
+		height,
+		nObs);
+
+	var lineObj = new d3.line()
+		.x(function(d) { return xScale(d.X); })
+		.y(function(d) { return yScale(d.Y); });
+
+	// Initialise the zoom behaviour. With tiles we allow zooming in until 
+	// every observation is shown.
+	var maxZoom = 100;
+	if (tileUrl !== null)
+		maxZoom = Math.max(maxZoom, nObs / 50);
 	var zoomObj = d3.zoom()
-		.scaleExtent([1, 100])
+		.scaleExtent([1, maxZoom])
 		.translateExtent([[0, 0], [width, height]])
 		.extent([[0, 0], [width, height]])
 		.on("zoom", zoomTransform);
+	if (tileUrl !== null)
+		zoomObj.on("end", zoomEnd);
 
 	function zoomTransform() {
 		transform = d3.event.transform;
 		// transform the axis
 		xScale.domain(transform.rescaleX(xScaleOrig).domain());
 
-		for (let r=0; r<data.length; r++) {
-			svg.select(".line-"+r).attr("d", lineObjects[r]);
+		gView.selectAll(".line").attr("d", lineObj);
 
-			// transform the circles
+		// transform the circles
+		for (let r=0; r<data.length; r++) {
 			pointSets[r].data(data[r])
 				.attr("cx", function(d) { return xScale(d.X); })
 				.attr("cy", function(d) { return yScale(d.Y); });
@@ -151,6 +185,40 @@ function baseChart(
 		svg.select(".axis--x").call(xAxis);
 	}
 
+	// Fetch a tile for the visible range when zooming stops. The tile 
+	// replaces the points on the graph, while keeping any selected points 
+	// (and their original index).
+	var tileTimer = null;
+	var tileRequest = 0;
+	function zoomEnd() {
+		if (tileTimer !== null)
+			clearTimeout(tileTimer);
+		tileTimer = setTimeout(fetchTile, 150);
+	}
+
+	function fetchTile() {
+		var domain = xScale.domain();
+		var start = Math.max(0, Math.floor(domain[0]));
+		var end = Math.min(nObs - 1, Math.ceil(domain[1]));
+		var url = tileUrl + "?start=" + start + "&end=" + end + 
+			"&width=" + Math.round(width);
+		var request = ++tileRequest;
+		d3.json(url, {credentials: "same-origin"}).then(function(tile) {
+			if (request !== tileRequest)
+				return; // a newer tile is on its way
+			var selected = {};
+			gView.selectAll(".changepoint").each(function(d) {
+				selected[d.X] = d;
+			});
+			data = preprocessData(mergeSelected(tile, selected));
+			drawData();
+			gView.selectAll("circle")
+				.filter(function(d) { return d.X in selected; })
+				.classed("changepoint", true)
+				.style("fill", "red");
+		});
+	}
+
 	// Build the SVG layer cake
 	// There are a few elements to this:
 	//
@@ -204,32 +272,41 @@ function baseChart(
 	var gView = gZoom.append("g")
 		.attr("class", "view");
 
-	// add the line(s) to the view
-	for (let r=0; r<data.length; r++) {
-		gView.append("path")
-			.datum(data[r])
-			.attr("class", "line line-"+r)
-			.attr("d", lineObjects[r]);
-	}
-
+	// add the line(s) and points to the view
 	var pointSets = [];
-	for (let r=0; r<data.length; r++) {
-		var wrap = gView.append("g");
-		var points = wrap.selectAll("circle")
-			.data(data[r])
-			.enter()
-			.append("circle")
-			.attr("cx", function(d) { return xScale(d.X); })
-			.attr("cy", function(d) { return yScale(d.Y); })
-			.attr("data_X", function(d) { return d.X; })
-			.attr("data_Y", function(d) { return d.Y; })
-			.attr("r", 5)
-			.on("click", function(d, i) {
-				d.element = this;
-				return clickFunction(d, i);
-			});
-		pointSets.push(points);
+	var points = null;
+	function drawData() {
+		gView.selectAll(".line").remove();
+		gView.selectAll(".points").remove();
+
+		for (let r=0; r<data.length; r++) {
+			gView.append("path")
+				.datum(data[r])
+				.attr("class", "line line-"+r)
+				.attr("d", lineObj);
+		}
+
+		pointSets = [];
+		for (let r=0; r<data.length; r++) {
+			var wrap = gView.append("g")
+				.attr("class", "points");
+			points = wrap.selectAll("circle")
+				.data(data[r])
+				.enter()
+				.append("circle")
+				.attr("cx", function(d) { return xScale(d.X); })
+				.attr("cy", function(d) { return yScale(d.Y); })
+				.attr("data_X", function(d) { return d.X; })
+				.attr("data_Y", function(d) { return d.Y; })
+				.attr("r", 5)
+				.on("click", function(d, i) {
+					d.element = this;
+					return clickFunction(d, i);
+				});
+			pointSets.push(points);
+		}
 	}
+	drawData();
 
 	// handle the annotations
 	annotations.forEach(function(a) {
@@ -243,7 +320,7 @@ function baseChart(
 	});
 }
 
-function annotateChart(selector, data) {
+function annotateChart(selector, data, tileUrl) {
 	function handleClick(d, i) {
 		if (d3.event.defaultPrevented) return; // zoomed
 		var elem = d3.select(d.element);
@@ -256,7 +333,7 @@ function annotateChart(selector, data) {
 		}
 		updateTable();
 	}
-	baseChart(selector, data, handleClick, [], null);
+	baseChart(selector, data, handleClick, [], null, null, null, tileUrl);
 }
 
 function viewAnnotations(selector, data, annotations) {
@@ -36,7 +36,7 @@ function preprocess(data) {
 function getLabelData(data, lbl) {
 	var lblData = [];
 	for (i=0; i<data.length; i++) {
-		if (isNaN(data[i][lbl]))
+		if (data[i][lbl] === null || isNaN(data[i][lbl]))
 			continue;
 		var item = {"X": data[i]["X"], "Y": data[i][lbl]};
 		lblData.push(item);
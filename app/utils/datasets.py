@@ -16,18 +16,83 @@ decoder).
 
 """
 
+import collections
+import copy
+import datetime
+import functools
+import glob
+import gzip
 import hashlib
 import json
 import jsonschema
 import logging
-import math
 import os
 
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
 from flask import current_app
 
+from app.utils.store import decode_series, open_store, write_store
+
 LOGGER = logging.getLogger(__file__)
 
 
+# File extensions of the precompressed chart payloads, by content encoding
+PAYLOAD_EXTENSIONS = {"gzip": ".json.gz", "br": ".json.br"}
+
+# Metadata of a dataset file, as gathered during ingestion. n_missing holds
+# the number of missing values of each series.
+DatasetRecord = collections.namedtuple(
+    "DatasetRecord",
+    [
+        "name",
+        "is_demo",
+        "md5sum",
+        "n_obs",
+        "n_dim",
+        "has_missing",
+        "n_missing",
+    ],
+)
+
+# Result of ingesting a dataset: the record, the parsed data, and the decoded
+# series (a list of store.SeriesColumn)
+IngestedDataset = collections.namedtuple(
+    "IngestedDataset", ["record", "data", "columns"]
+)
+
+
+def stat_signature(stat):
+    return (stat.st_ino, stat.st_mtime_ns, stat.st_size)
+
+
+def record_file_stat(dataset, stat):
+    """ Record the stat of a dataset file whose md5sum was just verified """
+    dataset.file_inode = stat.st_ino
+    dataset.file_mtime = stat.st_mtime_ns
+    dataset.file_size = stat.st_size
+    dataset.verified_on = datetime.datetime.utcnow()
+
+
+def dataset_needs_hashing(dataset, stat):
+    """ Whether the file needs a full md5sum check before we can trust it """
+    if current_app.config["DATASET_VERIFY"] == "md5":
+        return True
+    if dataset.verified_on is None:
+        return True
+    recorded = (dataset.file_inode, dataset.file_mtime, dataset.file_size)
+    if recorded != stat_signature(stat):
+        return True
+    interval = current_app.config["DATASET_SCRUB_INTERVAL"]
+    if not interval:
+        return False
+    age = datetime.datetime.utcnow() - dataset.verified_on
+    return age.total_seconds() > interval
+
+
 def load_schema():
     pth = os.path.abspath(__file__)
     basedir = os.path.dirname(pth)
@@ -39,26 +104,116 @@ def load_schema():
     return schema
 
 
-def validate_dataset(filename):
-    if not os.path.exists(filename):
-        return "File not found."
+@functools.lru_cache(maxsize=None)
+def get_validator():
+    """Create the (cached) validator for the dataset schema
+
+    The schemas for the items of the potentially long arrays are removed, as 
+    validating these element by element is slow. Instead, these are checked in 
+    bulk by check_arrays.
+    """
+    schema = copy.deepcopy(load_schema())
+    time = schema["properties"]["time"]["properties"]
+    del time["index"]["items"]
+    del time["raw"]["items"]
+    series = schema["properties"]["series"]["items"]["properties"]
+    del series["raw"]["items"]
+
+    cls = jsonschema.validators.validator_for(schema)
+    cls.check_schema(schema)
+    return cls(schema)
+
+
+def _is_integer(x):
+    # matches JSONSchema: bools are not integers, but 1.0 is
+    return (type(x) is int) or (type(x) is float and x.is_integer())
 
-    with open(filename, "rb") as fp:
-        try:
-            data = json.load(fp)
-        except json.JSONDecodeError as err:
-            return "JSON decoding error: %s" % err.msg
 
+def check_arrays(data):
+    """Check the item types of the arrays skipped by the validator
+
+    Returns the error message, or None if the items are valid.
+    """
+    if not "time" in data:
+        return None
+    index = data["time"].get("index", [])
+    types = set(map(type, index))
+    if not types <= {int}:
+        for x in index:
+            if not _is_integer(x):
+                return (
+                    "JSONSchema validation error: %r is not of type 'integer'"
+                    % x
+                )
+    raw = data["time"].get("raw", [])
+    types = set(map(type, raw))
+    if not types <= {str}:
+        if None in raw:
+            return "Null is not supported in time axis. Use 'NaN' instead."
+        for x in raw:
+            if not type(x) is str:
+                return (
+                    "JSONSchema validation error: %r is not of type 'string'"
+                    % x
+                )
+    return None
+
+
+def check_dataset(data):
+    """Validate parsed dataset data
+
+    Returns a tuple (error, columns), where error is None if the data is 
+    valid and columns holds the decoded values and missing value mask of each 
+    series.
+    """
     try:
-        schema = load_schema()
+        validator = get_validator()
     except FileNotFoundError:
-        return "Schema file not found."
+        return "Schema file not found.", None
+
+    err = jsonschema.exceptions.best_match(validator.iter_errors(data))
+    if not err is None:
+        return "JSONSchema validation error: %s" % err.message, None
+
+    error = check_arrays(data)
+    if not error is None:
+        return error, None
+
+    error = _check_dataset_contents(data)
+    if not error is None:
+        return error, None
+
+    columns = []
+    for var in data["series"]:
+        if len(var["raw"]) != data["n_obs"]:
+            return (
+                "Number of observations doesn't match for %s" % var["label"],
+                None,
+            )
+        try:
+            column = decode_series(var["raw"])
+        except TypeError:
+            if None in var["raw"]:
+                return (
+                    "Null is not supported in series. Use 'NaN' instead.",
+                    None,
+                )
+            return "Non-numeric value in series %s" % var["label"], None
+        columns.append(column)
+
+    # this doesn't happen in any dataset yet, so let's not implement it until
+    # we need it.
+    has_missing = any(c.n_missing for c in columns)
+    if data["n_dim"] > 1 and has_missing:
+        return (
+            "Missing values are not yet supported for multidimensional data",
+            None,
+        )
+
+    return None, columns
 
-    try:
-        jsonschema.validate(instance=data, schema=schema)
-    except jsonschema.ValidationError as err:
-        return "JSONSchema validation error: %s" % err.message
 
+def _check_dataset_contents(data):
     if len(data["series"]) != data["n_dim"]:
         return "Number of dimensions and number of series don't match"
 
@@ -75,35 +230,53 @@ def validate_dataset(filename):
         if "raw" in data["time"]:
             if len(data["time"]["raw"]) != data["n_obs"]:
                 return "Number of time points doesn't match number of observations"
-            if None in data["time"]["raw"]:
-                return "Null is not supported in time axis. Use 'NaN' instead."
+    return None
 
-    has_missing = False
-    for var in data["series"]:
-        if len(var["raw"]) != data["n_obs"]:
-            return "Number of observations doesn't match for %s" % var["label"]
-        if None in var["raw"]:
-            return "Null is not supported in series. Use 'NaN' instead."
-        has_missing = has_missing or any(map(math.isnan, var["raw"]))
 
-    # this doesn't happen in any dataset yet, so let's not implement it until
-    # we need it.
-    if data["n_dim"] > 1 and has_missing:
-        return "Missing values are not yet supported for multidimensional data"
+def ingest_dataset(fileobj, filename):
+    """Copy an uploaded dataset to filename and validate it in one pass
 
-    return None
+    The file object is read only once: the bytes are hashed and written to 
+    filename as they come in, and are then parsed and validated in memory.
 
+    Returns a tuple (ingested, error). On success error is None and ingested 
+    is an IngestedDataset. Otherwise ingested is None and error describes the 
+    problem.
+    """
+    blocksize = 65536
+    hasher = hashlib.md5()
+    chunks = []
+    with open(filename, "wb") as fid:
+        buf = fileobj.read(blocksize)
+        while len(buf) > 0:
+            hasher.update(buf)
+            fid.write(buf)
+            chunks.append(buf)
+            buf = fileobj.read(blocksize)
 
-def get_name_from_dataset(filename):
-    with open(filename, "rb") as fid:
-        data = json.load(fid)
-    return data["name"]
+    try:
+        data = json.loads(b"".join(chunks))
+    except json.JSONDecodeError as err:
+        return None, "JSON decoding error: %s" % err.msg
+    except UnicodeDecodeError:
+        return None, "JSON decoding error: file is not valid UTF-8"
+    del chunks
 
+    error, columns = check_dataset(data)
+    if not error is None:
+        return None, error
 
-def dataset_is_demo(filename):
-    with open(filename, "rb") as fid:
-        data = json.load(fid)
-    return "demo" in data.keys()
+    n_missing = tuple(c.n_missing for c in columns)
+    record = DatasetRecord(
+        name=data["name"],
+        is_demo="demo" in data,
+        md5sum=hasher.hexdigest(),
+        n_obs=data["n_obs"],
+        n_dim=data["n_dim"],
+        has_missing=any(n_missing),
+        n_missing=n_missing,
+    )
+    return IngestedDataset(record, data, columns), None
 
 
 def get_demo_true_cps(name):
@@ -128,39 +301,274 @@ def get_demo_true_cps(name):
 
 def md5sum(filename):
     """ Compute the MD5 hash for a given filename """
+    with open(filename, "rb") as fid:
+        return md5sum_fileobj(fid)
+
+
+def md5sum_fileobj(fid):
+    """ Compute the MD5 hash of an open file from its current position """
     blocksize = 65536
     hasher = hashlib.md5()
-    with open(filename, "rb") as fid:
+    buf = fid.read(blocksize)
+    while len(buf) > 0:
+        hasher.update(buf)
         buf = fid.read(blocksize)
-        while len(buf) > 0:
-            hasher.update(buf)
-            buf = fid.read(blocksize)
     return hasher.hexdigest()
 
 
-def load_data_for_chart(name, known_md5):
-    dataset_dir = os.path.join(
-        current_app.instance_path, current_app.config["DATASET_DIR"]
-    )
-    target_filename = os.path.join(dataset_dir, name + ".json")
-    if not os.path.exists(target_filename):
-        LOGGER.error("Dataset with name '%s' can't be found!" % name)
-        return None
-    if not md5sum(target_filename) == known_md5:
+def store_filename_for(filename):
+    """ Filename of the binary store that belongs to a dataset JSON file """
+    return os.path.splitext(filename)[0] + ".bin"
+
+
+def create_dataset_store(data, known_md5, filename, columns=None):
+    """ Write the binary store for a dataset, logging any failure """
+    try:
+        write_store(
+            data, known_md5, store_filename_for(filename), columns=columns
+        )
+    except (OSError, TypeError, ValueError) as err:
+        LOGGER.error(
+            "Failed to write binary store for dataset '%s': %s"
+            % (data["name"], err)
+        )
+
+
+def verify_dataset_file(dataset, fid):
+    """Check that an open dataset file is the one we expect
+
+    The full md5sum is only computed when dataset_needs_hashing says so, in 
+    which case the new stat is recorded on the dataset. The caller is 
+    responsible for committing this. The file position is undefined 
+    afterwards.
+    """
+    stat = os.fstat(fid.fileno())
+    if not dataset_needs_hashing(dataset, stat):
+        return True
+    checksum = md5sum_fileobj(fid)
+    if not checksum == dataset.md5sum:
         LOGGER.error(
             """
         MD5 checksum failed for dataset with name: %s.
         Found: %s.
         Expected: %s.
         """
-            % (name, md5sum(target_filename), known_md5)
+            % (dataset.name, checksum, dataset.md5sum)
         )
+        return False
+    record_file_stat(dataset, stat)
+    return True
+
+
+def load_data_for_chart(dataset):
+    name = dataset.name
+    dataset_dir = os.path.join(
+        current_app.instance_path, current_app.config["DATASET_DIR"]
+    )
+    target_filename = os.path.join(dataset_dir, name + ".json")
+    if not os.path.exists(target_filename):
+        LOGGER.error("Dataset with name '%s' can't be found!" % name)
+        return None
+
+    # Verify and parse from the same file descriptor, so that we use the file
+    # we actually checked.
+    with open(target_filename, "rb") as fid:
+        if not verify_dataset_file(dataset, fid):
+            return None
+
+        store = open_store(store_filename_for(target_filename), dataset.md5sum)
+        if store is None:
+            fid.seek(0)
+            data = json.load(fid)
+            chart_data = {
+                "time": data["time"] if "time" in data else None,
+                "values": data["series"],
+            }
+            # datasets added before we had binary stores get one now
+            create_dataset_store(data, dataset.md5sum, target_filename)
+        else:
+            with store:
+                chart_data = store.chart_data()
+    return {"chart_data": chart_data}
+
+
+def open_dataset_store(dataset):
+    """Open the binary store of a dataset after verifying the dataset file
+
+    The store is created if it doesn't exist yet. Returns None if the dataset 
+    file is missing or fails verification.
+    """
+    dataset_dir = os.path.join(
+        current_app.instance_path, current_app.config["DATASET_DIR"]
+    )
+    target_filename = os.path.join(dataset_dir, dataset.name + ".json")
+    if not os.path.exists(target_filename):
+        LOGGER.error("Dataset with name '%s' can't be found!" % dataset.name)
         return None
+
+    store_filename = store_filename_for(target_filename)
     with open(target_filename, "rb") as fid:
-        data = json.load(fid)
+        if not verify_dataset_file(dataset, fid):
+            return None
+        store = open_store(store_filename, dataset.md5sum)
+        if store is None:
+            fid.seek(0)
+            data = json.load(fid)
+            create_dataset_store(data, dataset.md5sum, target_filename)
+            store = open_store(store_filename, dataset.md5sum)
+    return store
 
-    chart_data = {
-        "time": data["time"] if "time" in data else None,
-        "values": data["series"],
-    }
+
+def load_tile_for_chart(dataset, start, end, width):
+    """Load a downsampled view of observations start to end (inclusive)
+
+    The view has about 2 * width points, and contains all observations in the 
+    range if there are no more than that. If end is None the view extends to 
+    the last observation. The chart data has an additional 'index' array with 
+    the original index of each point, and 'n_obs' with the length of the full 
+    series. Missing values are returned as None.
+    """
+    store = open_dataset_store(dataset)
+    if store is None:
+        return None
+    with store:
+        chart_data = store.tile(start, end, width)
     return {"chart_data": chart_data}
+
+
+def load_dataset_shape(dataset):
+    """ Return (n_obs, n_dim) of a dataset, or None if it can't be loaded """
+    store = open_dataset_store(dataset)
+    if store is None:
+        return None
+    with store:
+        return store.n_obs, store.n_dim
+
+
+def payload_filename_for(filename, known_md5, encoding):
+    """Filename of a precompressed chart payload of a dataset JSON file
+
+    The md5sum is part of the name, so a payload is never served for a 
+    different version of the dataset.
+    """
+    return "%s.%s%s" % (
+        os.path.splitext(filename)[0],
+        known_md5,
+        PAYLOAD_EXTENSIONS[encoding],
+    )
+
+
+def encode_chart_data(chart_data):
+    """Encode chart data as JSON, with missing values as null """
+    chart_data = dict(chart_data)
+    values = []
+    for var in chart_data["values"]:
+        var = dict(var)
+        var["raw"] = [None if x != x else x for x in var["raw"]]
+        values.append(var)
+    chart_data["values"] = values
+    payload = json.dumps(chart_data, separators=(",", ":"), allow_nan=False)
+    return payload.encode("utf-8")
+
+
+def create_chart_payloads(chart_data, known_md5, filename):
+    """Write the gzip (and, if available, brotli) compressed chart payloads
+
+    Failures are logged, in which case the payload is created again when it 
+    is first requested.
+    """
+    payload = encode_chart_data(chart_data)
+    compressors = {"gzip": lambda b: gzip.compress(b, compresslevel=9)}
+    if not brotli is None:
+        compressors["br"] = lambda b: brotli.compress(b, quality=11)
+    for encoding, compress in compressors.items():
+        target = payload_filename_for(filename, known_md5, encoding)
+        temp_filename = "%s.%i.tmp" % (target, os.getpid())
+        try:
+            with open(temp_filename, "wb") as fid:
+                fid.write(compress(payload))
+            os.replace(temp_filename, target)
+        except OSError as err:
+            LOGGER.error(
+                "Failed to write chart payload %s: %s" % (target, err)
+            )
+
+
+def load_chart_payload(dataset, encoding):
+    """Get the filename of the compressed chart payload of a dataset
+
+    The payloads are created if they don't exist yet. Returns None if the 
+    dataset can't be loaded or the payload isn't available in the requested 
+    encoding.
+    """
+    dataset_dir = os.path.join(
+        current_app.instance_path, current_app.config["DATASET_DIR"]
+    )
+    target_filename = os.path.join(dataset_dir, dataset.name + ".json")
+    payload_filename = payload_filename_for(
+        target_filename, dataset.md5sum, encoding
+    )
+    if os.path.exists(payload_filename):
+        return payload_filename
+
+    gzip_filename = payload_filename_for(
+        target_filename, dataset.md5sum, "gzip"
+    )
+    if not os.path.exists(gzip_filename):
+        # datasets added before we stored payloads get them now
+        data = load_data_for_chart(dataset)
+        if data is None:
+            return None
+        create_chart_payloads(
+            data["chart_data"], dataset.md5sum, target_filename
+        )
+    if os.path.exists(payload_filename):
+        return payload_filename
+    return None
+
+
+def remove_dataset_files(filename):
+    """ Remove a dataset JSON file and all files derived from it """
+    base = os.path.splitext(filename)[0]
+    derived = [store_filename_for(filename)]
+    for ext in PAYLOAD_EXTENSIONS.values():
+        derived.extend(glob.glob(base + ".*" + ext))
+    for fname in [filename] + derived:
+        if os.path.exists(fname):
+            os.unlink(fname)
+
+
+def prepare_dataset_files(filename, staging_dir):
+    """Ingest a dataset file and create all its files in staging_dir
+
+    This does not need the application context or the database, so it can be 
+    run in a worker process. The dataset file, its binary store and chart 
+    payloads are written to staging_dir, which should be empty.
+
+    Returns a tuple (record, error), with error None on success.
+    """
+    os.makedirs(staging_dir, exist_ok=True)
+    temp_filename = os.path.join(staging_dir, "upload.tmp")
+    try:
+        with open(filename, "rb") as fid:
+            ingested, error = ingest_dataset(fid, temp_filename)
+    except OSError as err:
+        return None, "Failed to read file: %s" % err
+    if not error is None:
+        if os.path.exists(temp_filename):
+            os.unlink(temp_filename)
+        return None, error
+
+    record, data = ingested.record, ingested.data
+    target_filename = os.path.join(staging_dir, record.name + ".json")
+    os.rename(temp_filename, target_filename)
+    create_dataset_store(
+        data, record.md5sum, target_filename, columns=ingested.columns
+    )
+    create_chart_payloads(
+        {"time": data.get("time"), "values": data["series"]},
+        record.md5sum,
+        target_filename,
+    )
+    return record, None
+
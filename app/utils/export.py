@@ -0,0 +1,335 @@
+# -*- coding: utf-8 -*-
+
+# Author: G.J.J. van den Burg <gvandenburg@turing.ac.uk>
+# License: See LICENSE file
+# Copyright: 2020 (c) The Alan Turing Institute
+
+"""Export of annotations
+
+The exports are generated from column-only queries that are read in batches
+(with a server-side cursor where the database driver supports it), and
+written out in chunks, so memory use doesn't grow with the number of
+annotations.
+
+Next to the row-wise CSV, annotations can be exported per task: NDJSON and
+(if pyarrow is installed) Parquet files have one row per (dataset, user,
+task) with the change point indices as a list. These files are cached in
+EXPORT_DIR (relative to the instance path) under the watermark of the
+annotations, so they are only written again after annotations have changed.
+When they are, the task records are read from the incremental export
+snapshot (see app.utils.snapshot).
+
+"""
+
+import csv
+import glob
+import hashlib
+import io
+import itertools
+import json
+import os
+import time
+
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+from flask import current_app
+from sqlalchemy import func
+
+from app import db
+from app.models import Annotation, Dataset, Task, TaskEvent, User
+
+# number of rows fetched from the database at a time
+EXPORT_BATCH_SIZE = 5000
+
+# approximate size of the chunks of an export that are yielded
+EXPORT_CHUNK_SIZE = 64 * 1024
+
+CSV_HEADER = [
+    "DatasetID",
+    "DatasetName",
+    "UserID",
+    "AnnotatedOn",
+    "AnnotationIndex",
+]
+
+# file extension and mimetype of the export formats
+EXPORT_FORMATS = {
+    "csv": ("csv", "text/csv"),
+    "ndjson": ("ndjson", "application/x-ndjson"),
+    "parquet": ("parquet", "application/vnd.apache.parquet"),
+}
+
+
+def annotation_rows():
+    """Query for (dataset id, dataset name, user id, annotated on, cp index)
+    of all annotations, ordered by dataset, username and index
+    """
+    return (
+        db.session.query(
+            Dataset.id,
+            Dataset.name,
+            Task.annotator_id,
+            Task.annotated_on,
+            Annotation.cp_index,
+        )
+        .select_from(Annotation)
+        .join(Task, Annotation.task)
+        .join(User, Task.user)
+        .join(Dataset, Task.dataset)
+        .order_by(Dataset.id, User.username, Annotation.cp_index)
+        .yield_per(EXPORT_BATCH_SIZE)
+    )
+
+
+def iter_annotations_csv():
+    """ Generate the CSV export of all annotations in chunks of text """
+    proxy = io.StringIO()
+    writer = csv.writer(proxy)
+    writer.writerow(CSV_HEADER)
+    for dataset_id, name, user_id, annotated_on, cp_index in annotation_rows():
+        writer.writerow(
+            [
+                dataset_id,
+                name,
+                user_id,
+                annotated_on,
+                "no_cp" if cp_index is None else cp_index,
+            ]
+        )
+        if proxy.tell() >= EXPORT_CHUNK_SIZE:
+            yield proxy.getvalue()
+            proxy.seek(0)
+            proxy.truncate()
+    yield proxy.getvalue()
+
+
+def available_formats():
+    """ The export formats that can be created with the installed packages """
+    if pyarrow is None:
+        return [fmt for fmt in EXPORT_FORMATS if not fmt == "parquet"]
+    return list(EXPORT_FORMATS)
+
+
+def task_records(*criteria):
+    """Iterate over the annotations of all finished tasks, one dict per task
+
+    Tasks are ordered by dataset and username like the CSV export. Tasks
+    where the user marked that there are no change points have an empty list
+    of change points. The tasks can be restricted with filter criteria.
+    """
+    rows = (
+        db.session.query(
+            Dataset.id,
+            Dataset.name,
+            Task.annotator_id,
+            Task.id,
+            Task.annotated_on,
+            Annotation.cp_index,
+        )
+        .select_from(Annotation)
+        .join(Task, Annotation.task)
+        .join(User, Task.user)
+        .join(Dataset, Task.dataset)
+        .filter(*criteria)
+        .order_by(Dataset.id, User.username, Task.id, Annotation.cp_index)
+        .yield_per(EXPORT_BATCH_SIZE)
+    )
+    for task_id, group in itertools.groupby(rows, key=lambda row: row[3]):
+        group = list(group)
+        dataset_id, name, user_id, _, annotated_on, _ = group[0]
+        yield {
+            "dataset_id": dataset_id,
+            "dataset_name": name,
+            "user_id": user_id,
+            "task_id": task_id,
+            "annotated_on": annotated_on,
+            "changepoints": [r[5] for r in group if not r[5] is None],
+        }
+
+
+def task_record_line(record):
+    """ Encode a task record as a line of JSON """
+    if not record.get("annotated_on") is None:
+        record = dict(record, annotated_on=record["annotated_on"].isoformat())
+    return json.dumps(record) + "\n"
+
+
+def iter_annotations_ndjson(records=None):
+    """Generate the NDJSON export of all tasks in chunks of text
+
+    The task records are taken from the task_records query, unless an
+    iterable of records is given.
+    """
+    if records is None:
+        records = task_records()
+    lines = []
+    size = 0
+    for record in records:
+        line = task_record_line(record)
+        lines.append(line)
+        size += len(line)
+        if size >= EXPORT_CHUNK_SIZE:
+            yield "".join(lines)
+            lines = []
+            size = 0
+    yield "".join(lines)
+
+
+def write_annotations_parquet(filename, records=None):
+    """Write the Parquet export of all tasks to filename
+
+    Every EXPORT_BATCH_SIZE tasks are written as a separate row group. The
+    records are taken from task_records, unless an iterable is given.
+    """
+    if pyarrow is None:
+        raise RuntimeError("The Parquet export requires pyarrow")
+    schema = pyarrow.schema(
+        [
+            ("dataset_id", pyarrow.int64()),
+            ("dataset_name", pyarrow.string()),
+            ("user_id", pyarrow.int64()),
+            ("task_id", pyarrow.int64()),
+            ("annotated_on", pyarrow.timestamp("us")),
+            ("changepoints", pyarrow.list_(pyarrow.int64())),
+        ]
+    )
+    if records is None:
+        records = task_records()
+    records = iter(records)
+    with pyarrow.parquet.ParquetWriter(filename, schema) as writer:
+        while True:
+            batch = list(itertools.islice(records, EXPORT_BATCH_SIZE))
+            if not batch:
+                break
+            writer.write_table(
+                pyarrow.Table.from_pylist(batch, schema=schema)
+            )
+
+
+def write_export(fmt, filename, records=None):
+    """Write the export of all annotations in the given format to filename
+
+    For the per task formats, records can be an iterable of task records to
+    export instead of those from task_records.
+    """
+    if fmt == "parquet":
+        write_annotations_parquet(filename, records=records)
+        return
+    if fmt == "csv":
+        chunks = iter_annotations_csv()
+    elif fmt == "ndjson":
+        chunks = iter_annotations_ndjson(records=records)
+    else:
+        raise ValueError("Unknown export format: %r" % fmt)
+    with open(filename, "w", encoding="utf-8", newline="") as fid:
+        for chunk in chunks:
+            fid.write(chunk)
+
+
+def export_watermark():
+    """Key that changes whenever the exported annotations change
+
+    This combines the most recent annotated_on with the number of finished
+    tasks and annotations (the counts catch deleted tasks), and the last
+    entry of the task event log (this catches tasks that were restored with
+    an older annotated_on, possibly with the same number of annotations).
+    """
+    n_tasks, last_annotated = (
+        db.session.query(func.count(Task.id), func.max(Task.annotated_on))
+        .filter(Task.done == True)
+        .one()
+    )
+    n_annotations = db.session.query(func.count(Annotation.id)).scalar()
+    last_event = db.session.query(func.max(TaskEvent.id)).scalar()
+    key = "%s/%i/%i/%s" % (last_annotated, n_tasks, n_annotations, last_event)
+    return hashlib.md5(key.encode("utf-8")).hexdigest()
+
+
+def cached_export(fmt, records=None):
+    """Filename of the export in the given format, created if needed
+
+    The export is written to a temporary file and moved into place, after
+    which exports of the same format for older watermarks are removed once
+    they have been replaced for EXPORT_GRACE_PERIOD seconds, since they may
+    still be downloaded. If given, records is called to get the task records
+    for the export.
+    """
+    export_dir = os.path.join(
+        current_app.instance_path, current_app.config["EXPORT_DIR"]
+    )
+    os.makedirs(export_dir, exist_ok=True)
+    ext, _ = EXPORT_FORMATS[fmt]
+    filename = os.path.join(
+        export_dir, "annotations-%s.%s" % (export_watermark(), ext)
+    )
+    if os.path.exists(filename):
+        return filename
+
+    temp_filename = "%s.%i.tmp" % (filename, os.getpid())
+    try:
+        write_export(
+            fmt, temp_filename, records=None if records is None else records()
+        )
+        os.replace(temp_filename, filename)
+    finally:
+        if os.path.exists(temp_filename):
+            os.unlink(temp_filename)
+
+    remove_old_exports(export_dir, ext)
+    return filename
+
+
+def remove_old_exports(export_dir, ext, now=None):
+    """Remove the cached exports that were replaced a while ago
+
+    An export is replaced when the next one is written, so it is removed if
+    the next newer export (by modification time) is older than
+    EXPORT_GRACE_PERIOD seconds. The newest export is always kept.
+    """
+    if now is None:
+        now = time.time()
+    grace = current_app.config["EXPORT_GRACE_PERIOD"]
+    exports = []
+    for name in glob.glob(os.path.join(export_dir, "annotations-*." + ext)):
+        try:
+            exports.append((os.path.getmtime(name), name))
+        except FileNotFoundError:
+            pass
+    exports.sort()
+    for (_, old), (replaced, _) in zip(exports, exports[1:]):
+        if replaced > now - grace:
+            break
+        try:
+            os.unlink(old)
+        except FileNotFoundError:
+            pass
+
+
+def dataset_annotations(dataset_id):
+    """The anonymised annotations of a dataset
+
+    Returns a list of dicts with the user (numbered as 'user-1', 'user-2',
+    etc. in order of username) and the index of the change point (None if
+    the user marked that there are no change points). The query only reads
+    the tasks of the dataset and their annotations, through the indexes on
+    task.dataset_id and annotation.task_id.
+    """
+    rows = (
+        db.session.query(Task.annotator_id, Annotation.cp_index)
+        .select_from(Annotation)
+        .join(Task, Annotation.task)
+        .join(User, Task.user)
+        .filter(Task.dataset_id == dataset_id)
+        .order_by(User.username, Annotation.cp_index)
+    )
+    annotations = []
+    user_counter = {}
+    for user_id, cp_index in rows:
+        if not user_id in user_counter:
+            user_counter[user_id] = "user-%i" % (len(user_counter) + 1)
+        annotations.append(dict(user=user_counter[user_id], index=cp_index))
+    return annotations
@@ -0,0 +1,281 @@
+# -*- coding: utf-8 -*-
+
+# Author: G.J.J. van den Burg <gvandenburg@turing.ac.uk>
+# License: See LICENSE file
+# Copyright: 2020 (c) The Alan Turing Institute
+
+"""Append-only journal of annotation records
+
+Every recorded annotation is appended as a line of JSON to
+'annotations.jsonl' in the journal directory (JOURNAL_DIR, relative to the
+instance path), and so is the deletion of a finished task (a record with
+"deleted": true), so that replaying the journal doesn't restore it. Writes
+from all processes are serialized with an exclusive flock on the file, and a
+record is only acknowledged once it has been synced to disk. Concurrent
+writers in a process share a single fsync (group commit): the first writer
+waits JOURNAL_COMMIT_DELAY seconds for others to join and then syncs for all
+of them.
+
+When the journal grows beyond JOURNAL_MAX_BYTES it is renamed to
+'annotations-<timestamp>.jsonl' and a new file is started. Processes that
+still have the old file open notice this when they next take the lock.
+
+"""
+
+import collections
+import datetime
+import errno
+import fcntl
+import glob
+import json
+import os
+import threading
+import time
+
+from flask import current_app
+
+from app import db
+from app.models import Annotation, Dataset, Task, User
+from app.utils.tasks import add_task, finish_task, record_task_event
+
+JOURNAL_NAME = "annotations.jsonl"
+
+
+class Journal(object):
+    def __init__(self, directory, max_bytes, commit_delay):
+        self.directory = directory
+        self.filename = os.path.join(directory, JOURNAL_NAME)
+        self.max_bytes = max_bytes
+        self.commit_delay = commit_delay
+        self._fd = None
+        self._cond = threading.Condition()
+        self._written = 0
+        self._synced = 0
+        self._syncing = False
+        self.pid = os.getpid()
+        os.makedirs(directory, exist_ok=True)
+
+    def _open(self):
+        if not self._fd is None:
+            os.close(self._fd)
+        self._fd = os.open(
+            self.filename, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o640
+        )
+
+    def _is_current(self):
+        """ Whether our file descriptor is for the current journal file """
+        if self._fd is None:
+            return False
+        try:
+            current = os.stat(self.filename)
+        except FileNotFoundError:
+            return False
+        return os.fstat(self._fd).st_ino == current.st_ino
+
+    def _lock(self):
+        while True:
+            if not self._is_current():
+                self._open()
+            fcntl.flock(self._fd, fcntl.LOCK_EX)
+            # another process may have rotated the file while we waited
+            if self._is_current():
+                return
+            fcntl.flock(self._fd, fcntl.LOCK_UN)
+
+    def _rotate(self):
+        stamp = datetime.datetime.utcnow().strftime("%Y%m%dT%H%M%S%f")
+        target = os.path.join(self.directory, "annotations-%s.jsonl" % stamp)
+        os.fsync(self._fd)
+        os.rename(self.filename, target)
+        self._open()
+
+    def append(self, record):
+        """ Append a record and return once it is safely on disk """
+        line = (json.dumps(record, sort_keys=True) + "\n").encode("utf-8")
+        with self._cond:
+            self._lock()
+            try:
+                if os.fstat(self._fd).st_size >= self.max_bytes:
+                    self._rotate()
+                    fcntl.flock(self._fd, fcntl.LOCK_EX)
+                os.write(self._fd, line)
+            finally:
+                fcntl.flock(self._fd, fcntl.LOCK_UN)
+            self._written += 1
+            seq = self._written
+
+            while self._synced < seq:
+                if self._syncing:
+                    self._cond.wait()
+                    continue
+                # become the leader and sync on behalf of everyone waiting
+                self._syncing = True
+                self._cond.release()
+                try:
+                    if self.commit_delay > 0:
+                        time.sleep(self.commit_delay)
+                    with self._cond:
+                        target, fd = self._written, self._fd
+                    try:
+                        os.fsync(fd)
+                    except OSError as err:
+                        # the file was rotated (and synced) in the meantime
+                        if not err.errno == errno.EBADF:
+                            raise
+                finally:
+                    self._cond.acquire()
+                    self._syncing = False
+                self._synced = max(self._synced, target)
+                self._cond.notify_all()
+
+
+_JOURNAL = None
+_JOURNAL_LOCK = threading.Lock()
+
+
+def get_journal():
+    """ The journal of the current app, (re)created after a fork """
+    global _JOURNAL
+    directory = os.path.join(
+        current_app.instance_path, current_app.config["JOURNAL_DIR"]
+    )
+    with _JOURNAL_LOCK:
+        if (
+            _JOURNAL is None
+            or not _JOURNAL.directory == directory
+            or not _JOURNAL.pid == os.getpid()
+        ):
+            _JOURNAL = Journal(
+                directory,
+                current_app.config["JOURNAL_MAX_BYTES"],
+                current_app.config["JOURNAL_COMMIT_DELAY"],
+            )
+        return _JOURNAL
+
+
+def write_journal_record(record):
+    get_journal().append(record)
+
+
+def journal_task_deletion(task):
+    """Record the deletion of a finished task in the journal
+
+    Replaying the journal would otherwise restore the task.
+    """
+    if not "journal" in current_app.config["ANNOTATION_BACKUP"]:
+        return
+    record = {
+        "user_id": task.annotator_id,
+        "dataset_name": task.dataset.name,
+        "dataset_id": task.dataset_id,
+        "task_id": task.id,
+        "deleted_on": datetime.datetime.utcnow().isoformat(),
+        "deleted": True,
+    }
+    write_journal_record(record)
+
+
+def journal_files(directory):
+    """ All journal files in the directory, oldest first """
+    rotated = sorted(glob.glob(os.path.join(directory, "annotations-*.jsonl")))
+    current = os.path.join(directory, JOURNAL_NAME)
+    if os.path.exists(current):
+        rotated.append(current)
+    return rotated
+
+
+def read_journal(directory):
+    """Iterate over the records in the journal, oldest first
+
+    A partially written last line (e.g. after a crash) is skipped.
+    """
+    for filename in journal_files(directory):
+        with open(filename, "r", encoding="utf-8") as fid:
+            for line in fid:
+                if not line.endswith("\n"):
+                    break
+                yield json.loads(line)
+
+
+def journal_changepoints(record):
+    """ The change point indices of a journal record (None if no CPs) """
+    changepoints = record["annotations_raw"]["changepoints"]
+    if changepoints is None:
+        return None
+    return [int(cp["x"]) for cp in changepoints]
+
+
+def _same_changepoints(a, b):
+    if a is None or b is None:
+        return a is None and b is None
+    return sorted(a) == sorted(b)
+
+
+def replay_journal(directory, verify=False):
+    """Compare the annotations in the database with those in the journal
+
+    For every (user, dataset) pair the most recent journal record is compared
+    with the task in the database. Unless verify is True, tasks that are
+    missing or whose annotations differ are restored from the journal (tasks
+    whose user or dataset no longer exists are skipped). Pairs whose most
+    recent record is the deletion of the task are left alone. Returns a
+    Counter of the outcomes and a list of (record, problem) for every
+    difference.
+    """
+    latest = {}
+    for record in read_journal(directory):
+        latest[(record["user_id"], record["dataset_id"])] = record
+
+    stats = collections.Counter()
+    problems = []
+    for (user_id, dataset_id), record in latest.items():
+        if record.get("deleted"):
+            stats["deleted"] += 1
+            continue
+        expected = journal_changepoints(record)
+        task = Task.query.filter_by(
+            annotator_id=user_id, dataset_id=dataset_id
+        ).first()
+        if task is None:
+            problem = "missing task"
+        else:
+            rows = db.session.query(Annotation.cp_index).filter(
+                Annotation.task_id == task.id
+            )
+            actual = [cp_index for cp_index, in rows]
+            actual = None if actual == [None] else actual
+            if not task.done:
+                problem = "task not done"
+            elif not _same_changepoints(actual, expected):
+                problem = "annotations differ"
+            else:
+                problem = None
+
+        if problem is None:
+            stats["ok"] += 1
+            continue
+        stats[problem] += 1
+        problems.append((record, problem))
+        if verify:
+            continue
+
+        if task is None:
+            user = User.query.filter_by(id=user_id).first()
+            dataset = Dataset.query.filter_by(id=dataset_id).first()
+            if user is None or dataset is None:
+                stats["skipped"] += 1
+                continue
+            task = Task(annotator_id=user_id, dataset_id=dataset_id)
+            add_task(task)
+            db.session.flush()
+
+        # the restored annotated_on may be older than the export snapshot
+        record_task_event(task.id, "restored")
+        annotated_on = None
+        if record.get("annotated_on"):
+            annotated_on = datetime.datetime.fromisoformat(
+                record["annotated_on"]
+            )
+        finish_task(task, expected, annotated_on=annotated_on)
+        stats["restored"] += 1
+    return stats, problems
@@ -0,0 +1,271 @@
+# -*- coding: utf-8 -*-
+
+# Author: G.J.J. van den Burg <gvandenburg@turing.ac.uk>
+# License: See LICENSE file
+# Copyright: 2020 (c) The Alan Turing Institute
+
+"""Incremental export snapshot of the annotations
+
+The snapshot is the file 'tasks.ndjson' in the 'snapshot' directory of
+EXPORT_DIR, with a line per finished task in the format of the NDJSON export
+(see app.utils.export). It is only appended to. A task that is annotated
+again is appended again, and a deleted task gets a line {"task_id": ...,
+"deleted": true}. The last line of a task wins, and snapshot_records sorts
+the records in the order of the other exports.
+
+The manifest 'snapshot.json' records how far the snapshot is complete: the
+annotated_on watermark, the id of the last processed entry of the task event
+log, and the size of the data file. An update only queries the task events
+after that id and the tasks annotated on or after the watermark, so its cost
+depends on the number of new annotations rather than on all of them.
+
+Since annotated_on is set before a task is committed, the watermark is kept
+EXPORT_SNAPSHOT_LAG seconds behind the current time. The tasks in that window
+that are already in the snapshot are listed in the manifest, so they aren't
+appended twice.
+
+"""
+
+import contextlib
+import datetime
+import fcntl
+import json
+import os
+
+from flask import current_app
+from sqlalchemy import func, or_
+
+from app import db
+from app.models import Task, TaskEvent, User
+from app.utils.export import task_record_line, task_records
+
+SNAPSHOT_NAME = "tasks.ndjson"
+MANIFEST_NAME = "snapshot.json"
+LOCK_NAME = "snapshot.lock"
+
+
+def snapshot_dir():
+    return os.path.join(
+        current_app.instance_path, current_app.config["EXPORT_DIR"], "snapshot"
+    )
+
+
+def _parse_time(value):
+    if value is None:
+        return None
+    return datetime.datetime.fromisoformat(value)
+
+
+def read_manifest(directory):
+    """ The manifest of the snapshot in directory (empty if there is none) """
+    filename = os.path.join(directory, MANIFEST_NAME)
+    if not os.path.exists(filename):
+        return {
+            "watermark": None,
+            "last_event_id": 0,
+            "size": 0,
+            "recent": {},
+        }
+    with open(filename, "r", encoding="utf-8") as fid:
+        return json.load(fid)
+
+
+def _write_manifest(directory, manifest):
+    filename = os.path.join(directory, MANIFEST_NAME)
+    temp_filename = "%s.%i.tmp" % (filename, os.getpid())
+    with open(temp_filename, "w", encoding="utf-8") as fid:
+        json.dump(manifest, fid)
+        fid.flush()
+        os.fsync(fid.fileno())
+    os.replace(temp_filename, filename)
+
+
+@contextlib.contextmanager
+def _locked(directory):
+    """ Hold an exclusive lock on the snapshot in directory """
+    os.makedirs(directory, exist_ok=True)
+    fd = os.open(
+        os.path.join(directory, LOCK_NAME), os.O_RDWR | os.O_CREAT, 0o640
+    )
+    try:
+        fcntl.flock(fd, fcntl.LOCK_EX)
+        yield
+    finally:
+        os.close(fd)
+
+
+def update_snapshot(directory=None, now=None):
+    """Append the changes since the last update to the export snapshot
+
+    Without a snapshot, all finished tasks are written. Data that was
+    appended by an update that didn't finish is discarded first. Returns the
+    number of lines that were appended.
+    """
+    if directory is None:
+        directory = snapshot_dir()
+    if now is None:
+        now = datetime.datetime.utcnow()
+    lag = current_app.config["EXPORT_SNAPSHOT_LAG"]
+    lag = datetime.timedelta(seconds=lag)
+
+    with _locked(directory):
+        manifest = read_manifest(directory)
+        watermark = _parse_time(manifest["watermark"])
+        recent = manifest["recent"]
+
+        lines = []
+        restored = set()
+        last_event_id = manifest["last_event_id"]
+        if watermark is None:
+            # a new snapshot has all tasks, so earlier events don't matter
+            last_event_id = db.session.query(func.max(TaskEvent.id)).scalar()
+            last_event_id = last_event_id or 0
+        events = (
+            db.session.query(TaskEvent.id, TaskEvent.task_id, TaskEvent.event)
+            .filter(TaskEvent.id > last_event_id)
+            .order_by(TaskEvent.id)
+        )
+        for event_id, task_id, event in events:
+            last_event_id = event_id
+            if event == "deleted":
+                lines.append(json.dumps({"task_id": task_id, "deleted": True}))
+                recent.pop(str(task_id), None)
+                restored.discard(task_id)
+            else:
+                restored.add(task_id)
+
+        criteria = [Task.done == True]
+        if not watermark is None:
+            changed = Task.annotated_on >= watermark
+            if restored:
+                changed = or_(changed, Task.id.in_(restored))
+            criteria.append(changed)
+
+        horizon = now - lag
+        if not watermark is None and watermark > horizon:
+            horizon = watermark
+
+        filename = os.path.join(directory, SNAPSHOT_NAME)
+        if (
+            os.path.exists(filename)
+            and os.path.getsize(filename) > manifest["size"]
+        ):
+            os.truncate(filename, manifest["size"])
+
+        window = {}
+        n_lines = len(lines)
+        with open(filename, "ab") as fid:
+            for line in lines:
+                fid.write((line + "\n").encode("utf-8"))
+            for record in task_records(*criteria):
+                key = str(record["task_id"])
+                annotated_on = record["annotated_on"]
+                if not annotated_on is None:
+                    annotated_on = annotated_on.isoformat()
+                    if record["annotated_on"] >= horizon:
+                        window[key] = annotated_on
+                # compare with the previous window, as the task may have
+                # left the new one since it was written
+                if (
+                    key in recent
+                    and recent[key] == annotated_on
+                    and not record["task_id"] in restored
+                ):
+                    continue
+                fid.write(task_record_line(record).encode("utf-8"))
+                n_lines += 1
+            fid.flush()
+            os.fsync(fid.fileno())
+            size = fid.tell()
+
+        manifest = {
+            "watermark": horizon.isoformat(),
+            "last_event_id": last_event_id,
+            "size": size,
+            "recent": window,
+        }
+        _write_manifest(directory, manifest)
+    return n_lines
+
+
+def _read_lines(directory, size):
+    """ Iterate over the (offset, record) in the first size bytes """
+    filename = os.path.join(directory, SNAPSHOT_NAME)
+    if size == 0:
+        return
+    with open(filename, "rb") as fid:
+        offset = 0
+        while offset < size:
+            line = fid.readline()
+            if not line:
+                break
+            yield offset, json.loads(line)
+            offset += len(line)
+
+
+def snapshot_records(directory=None):
+    """Iterate over the task records in the snapshot
+
+    Only the last line of every task is used, and deleted tasks are left
+    out. The records are ordered by dataset, username and task like those of
+    task_records, so exports from the snapshot are ordered like the CSV.
+    """
+    if directory is None:
+        directory = snapshot_dir()
+    size = read_manifest(directory)["size"]
+    last = {}
+    for offset, record in _read_lines(directory, size):
+        if record.get("deleted"):
+            last.pop(record["task_id"], None)
+            continue
+        last[record["task_id"]] = (
+            record["dataset_id"],
+            record["user_id"],
+            offset,
+        )
+    if not last:
+        return
+
+    usernames = dict(db.session.query(User.id, User.username))
+    order = sorted(
+        (dataset_id, usernames.get(user_id, ""), task_id, offset)
+        for task_id, (dataset_id, user_id, offset) in last.items()
+    )
+    filename = os.path.join(directory, SNAPSHOT_NAME)
+    with open(filename, "rb") as fid:
+        for _, _, _, offset in order:
+            fid.seek(offset)
+            record = json.loads(fid.readline())
+            record["annotated_on"] = _parse_time(record["annotated_on"])
+            yield record
+
+
+def compact_snapshot(directory=None):
+    """Rewrite the snapshot with only the current record of every task
+
+    Returns the number of lines that were removed.
+    """
+    if directory is None:
+        directory = snapshot_dir()
+    with _locked(directory):
+        manifest = read_manifest(directory)
+        n_before = sum(1 for _ in _read_lines(directory, manifest["size"]))
+        filename = os.path.join(directory, SNAPSHOT_NAME)
+        temp_filename = "%s.%i.tmp" % (filename, os.getpid())
+        n_after = 0
+        with open(temp_filename, "wb") as fid:
+            for record in snapshot_records(directory):
+                fid.write(task_record_line(record).encode("utf-8"))
+                n_after += 1
+            fid.flush()
+            os.fsync(fid.fileno())
+            manifest["size"] = fid.tell()
+        os.replace(temp_filename, filename)
+        _write_manifest(directory, manifest)
+    return n_before - n_after
+
+
+def current_snapshot_records():
+    """ Update the export snapshot and iterate over its task records """
+    update_snapshot()
+    return snapshot_records()
@@ -0,0 +1,306 @@
+# -*- coding: utf-8 -*-
+
+# Author: G.J.J. van den Burg <gvandenburg@turing.ac.uk>
+# License: See LICENSE file
+# Copyright: 2020 (c) The Alan Turing Institute
+
+"""
+Binary columnar storage of datasets
+
+Next to every '<name>.json' dataset file we keep a '<name>.bin' file that
+holds the same data in a form that can be memory-mapped. The layout is:
+
+    8 bytes     magic and format version
+    8 bytes     length of the header (unsigned, little endian)
+    header      JSON encoded metadata, padded with spaces to 8 bytes
+    arrays      the data arrays, each starting on an 8 byte boundary
+
+The header records the md5sum of the JSON file the store was created from,
+the small non-numeric fields of the dataset, and the offset and length of
+each array (relative to the start of the array section). For every series we
+store the values as float64 and a mask with one byte per observation that is
+1 where the value is missing. The time index, if any, is stored as int64, and
+the raw time stamps as a JSON encoded array of strings. The size of the
+header therefore doesn't depend on the number of observations, so opening a
+store is cheap.
+
+"""
+
+import array
+import collections
+import json
+import math
+import mmap
+import os
+import struct
+import sys
+
+MAGIC = b"ACDS\x00\x00\x00\x02"
+ALIGN = 8
+
+# Decoded values of a series with its missing value mask
+SeriesColumn = collections.namedtuple(
+    "SeriesColumn", ["values", "mask", "n_missing"]
+)
+
+
+def decode_series(raw):
+    """Decode the raw values of a series into a float64 array and NaN mask
+
+    Raises TypeError if raw contains anything that isn't a number.
+    """
+    values = array.array("d", raw)
+    mask = bytes(map(math.isnan, values))
+    return SeriesColumn(values, mask, mask.count(1))
+
+
+class DatasetStore(object):
+    """Read-only view of a memory-mapped dataset store"""
+
+    def __init__(self, filename):
+        with open(filename, "rb") as fid:
+            self._mmap = mmap.mmap(fid.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            if not self._mmap[: len(MAGIC)] == MAGIC:
+                raise ValueError("Not a dataset store: %s" % filename)
+            (header_len,) = struct.unpack_from("<Q", self._mmap, len(MAGIC))
+            start = len(MAGIC) + 8
+            self.header = json.loads(
+                self._mmap[start : start + header_len].decode("utf-8")
+            )
+            if not self.header["byteorder"] == sys.byteorder:
+                raise ValueError("Byte order mismatch for: %s" % filename)
+        except:
+            self._mmap.close()
+            raise
+        self._view = memoryview(self._mmap)
+        self._data_start = start + header_len
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        self._view.release()
+        try:
+            self._mmap.close()
+        except BufferError:
+            # views on the data are still in use, the mapping is closed when
+            # these are garbage collected.
+            pass
+
+    @property
+    def md5sum(self):
+        return self.header["md5sum"]
+
+    @property
+    def n_obs(self):
+        return self.header["n_obs"]
+
+    @property
+    def n_dim(self):
+        return self.header["n_dim"]
+
+    def _array(self, spec, fmt):
+        start = self._data_start + spec["offset"]
+        end = start + spec["nbytes"]
+        return self._view[start:end].cast(fmt)
+
+    def values(self, j):
+        """ Values of the j-th series as a float64 memoryview """
+        return self._array(self.header["series"][j]["values"], "d")
+
+    def mask(self, j):
+        """ Missing value mask of the j-th series as a memoryview of bytes """
+        return self._array(self.header["series"][j]["mask"], "B")
+
+    def n_missing(self, j):
+        return self.header["series"][j]["n_missing"]
+
+    def time_index(self):
+        time = self.header["time"]
+        if time is None or not "index" in time:
+            return None
+        return self._array(time["index"], "q")
+
+    def chart_data(self):
+        """ Reconstruct the chart data of the original JSON file """
+        time = self.header["time"]
+        if not time is None:
+            time = dict(time["fields"])
+            index = self.time_index()
+            if not index is None:
+                time["index"] = index.tolist()
+            if "raw" in self.header["time"]:
+                raw = self._array(self.header["time"]["raw"], "B")
+                time["raw"] = json.loads(raw.tobytes().decode("utf-8"))
+                raw.release()
+        values = []
+        for j, var in enumerate(self.header["series"]):
+            var = dict(var["fields"])
+            var["raw"] = self.values(j).tolist()
+            values.append(var)
+        return {"time": time, "values": values}
+
+    def tile(self, start, end, n_buckets):
+        """Downsampled chart data for observations start to end (inclusive)
+
+        See downsample for how points are selected. The original indices of 
+        the points are in 'index' and missing values are None, so the result 
+        can be encoded as strict JSON.
+        """
+        index = downsample(self, start, end, n_buckets)
+        values = []
+        for j, var in enumerate(self.header["series"]):
+            column = self.values(j)
+            var = dict(var["fields"])
+            var["raw"] = [column[i] for i in index]
+            var["raw"] = [None if x != x else x for x in var["raw"]]
+            values.append(var)
+            column.release()
+        return {
+            "time": None,
+            "values": values,
+            "index": index,
+            "n_obs": self.n_obs,
+        }
+
+
+def downsample(store, start, end, n_buckets):
+    """Min/max downsampling of observations start to end (inclusive)
+
+    The range is split into n_buckets buckets and in every bucket we keep, for 
+    each series, the position of the minimum, the maximum, and the first 
+    missing value (so that gaps remain visible). The end points of the range 
+    are always kept. If the range has at most 2 * n_buckets observations, all 
+    of them are kept. If end is None the range extends to the last 
+    observation. Returns the sorted list of selected indices.
+    """
+    start = max(0, start)
+    if end is None:
+        end = store.n_obs - 1
+    end = min(store.n_obs - 1, end)
+    n = end - start + 1
+    if n <= 0:
+        return []
+    n_buckets = max(1, n_buckets)
+    if n <= 2 * n_buckets:
+        return list(range(start, end + 1))
+
+    selected = {start, end}
+    bounds = [start + (b * n) // n_buckets for b in range(n_buckets + 1)]
+    for j in range(store.n_dim):
+        values = store.values(j)
+        mask = store.mask(j)
+        has_missing = store.n_missing(j) > 0
+        for a, z in zip(bounds[:-1], bounds[1:]):
+            chunk = values[a:z].tolist()
+            if has_missing:
+                first = mask[a:z].tobytes().find(1)
+                if first >= 0:
+                    selected.add(a + first)
+                    chunk_lo = [math.inf if x != x else x for x in chunk]
+                    chunk_hi = [-math.inf if x != x else x for x in chunk]
+                    lo, hi = min(chunk_lo), max(chunk_hi)
+                    if lo == math.inf:
+                        continue
+                    selected.add(a + chunk_lo.index(lo))
+                    selected.add(a + chunk_hi.index(hi))
+                    continue
+            selected.add(a + chunk.index(min(chunk)))
+            selected.add(a + chunk.index(max(chunk)))
+        values.release()
+        mask.release()
+    return sorted(selected)
+
+
+def write_store(data, md5sum, filename, columns=None):
+    """Write a dataset store for parsed (and validated) dataset data
+
+    If the series have already been decoded (during validation), the 
+    SeriesColumn for each can be supplied in columns. The file is written to a 
+    temporary location first and moved into place, so concurrent readers never 
+    see a partially written store.
+    """
+    if columns is None:
+        columns = [decode_series(var["raw"]) for var in data["series"]]
+
+    chunks = []
+    offset = 0
+
+    def add_chunk(buf):
+        nonlocal offset
+        spec = {"offset": offset, "nbytes": len(buf)}
+        pad = -len(buf) % ALIGN
+        chunks.append(buf)
+        chunks.append(b"\x00" * pad)
+        offset += len(buf) + pad
+        return spec
+
+    time = None
+    if "time" in data:
+        time = {
+            "fields": {
+                k: v
+                for k, v in data["time"].items()
+                if not k in ("index", "raw")
+            }
+        }
+        if "index" in data["time"]:
+            # validation also accepts integral floats such as 1.0
+            index = array.array("q", map(int, data["time"]["index"]))
+            time["index"] = add_chunk(index.tobytes())
+        if "raw" in data["time"]:
+            raw = json.dumps(data["time"]["raw"]).encode("utf-8")
+            time["raw"] = add_chunk(raw)
+
+    series = []
+    for var, column in zip(data["series"], columns):
+        series.append(
+            {
+                "fields": {k: v for k, v in var.items() if k != "raw"},
+                "values": add_chunk(column.values.tobytes()),
+                "mask": add_chunk(column.mask),
+                "n_missing": column.n_missing,
+            }
+        )
+
+    header = {
+        "md5sum": md5sum,
+        "byteorder": sys.byteorder,
+        "n_obs": data["n_obs"],
+        "n_dim": data["n_dim"],
+        "time": time,
+        "series": series,
+    }
+    header = json.dumps(header).encode("utf-8")
+    header += b" " * (-(len(MAGIC) + 8 + len(header)) % ALIGN)
+
+    temp_filename = "%s.%i.tmp" % (filename, os.getpid())
+    with open(temp_filename, "wb") as fid:
+        fid.write(MAGIC)
+        fid.write(struct.pack("<Q", len(header)))
+        fid.write(header)
+        for chunk in chunks:
+            fid.write(chunk)
+    os.replace(temp_filename, filename)
+
+
+def open_store(filename, md5sum):
+    """Open the store in filename if it exists and matches the md5sum
+
+    Returns None if the store is missing, unreadable, or was created from a
+    different version of the dataset.
+    """
+    if not os.path.exists(filename):
+        return None
+    try:
+        store = DatasetStore(filename)
+    except (OSError, ValueError, KeyError):
+        return None
+    if not store.md5sum == md5sum:
+        store.close()
+        return None
+    return store
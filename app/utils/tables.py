@@ -0,0 +1,146 @@
+# -*- coding: utf-8 -*-
+
+# Author: G.J.J. van den Burg <gvandenburg@turing.ac.uk>
+# License: See LICENSE file
+# Copyright: 2020 (c) The Alan Turing Institute
+
+"""Server-side processing of DataTables tables
+
+This implements the server-side processing protocol of DataTables 1.10
+(https://datatables.net/manual/server-side), with sorting, searching and
+paging done in the database. Only the first sort column is used.
+
+Pages are fetched with keyset pagination where possible: every response
+contains a cursor with the sort value and key of its last row, and a
+request for the next page that sends this cursor back (as 'after') continues
+from there with a WHERE clause instead of an OFFSET. Jumping to an arbitrary
+page, and sorting on a column that can be NULL, use an OFFSET.
+
+"""
+
+import collections
+import json
+
+from sqlalchemy import and_, func, literal, or_
+
+# largest page that is returned, also when all rows are requested
+MAX_PAGE_LENGTH = 1000
+
+# A column of the table. The expression is used for sorting and (if
+# searchable) for the global search, which matches a substring.
+Column = collections.namedtuple(
+    "Column", ["expression", "nullable", "searchable"]
+)
+
+
+def _int_arg(args, name, default):
+    try:
+        return int(args.get(name, default))
+    except (TypeError, ValueError):
+        return default
+
+
+class ServerSideTable(object):
+    """A table for DataTables' server-side processing
+
+    The query must select the expressions of the columns in order, followed
+    by a unique key of the rows (used to break ties when sorting). The
+    render function turns a row of the query into the list of cells.
+    """
+
+    def __init__(self, query, columns, render):
+        self.query = query
+        self.columns = columns
+        self.render = render
+        self.key = query.column_descriptions[-1]["expr"]
+
+    def _search(self, query, value):
+        if not value:
+            return query
+        return query.filter(
+            or_(
+                *[
+                    c.expression.contains(value, autoescape=True)
+                    for c in self.columns
+                    if c.searchable
+                ]
+            )
+        )
+
+    def _count(self, query):
+        return query.with_entities(func.count(self.key)).scalar()
+
+    def _after(self, column, descending, cursor):
+        """ WHERE clause for the rows after the cursor in the sort order """
+        value, key = cursor
+        # a literal of the column type, so that e.g. booleans can be compared
+        value = literal(value, column.expression.type)
+        if descending:
+            after_key = self.key < key
+            after_value = column.expression < value
+        else:
+            after_key = self.key > key
+            after_value = column.expression > value
+        return or_(after_value, and_(column.expression == value, after_key))
+
+    def response(self, args):
+        """ The DataTables response for the request arguments """
+        draw = _int_arg(args, "draw", 0)
+        start = max(0, _int_arg(args, "start", 0))
+        length = _int_arg(args, "length", 10)
+        if length < 0 or length > MAX_PAGE_LENGTH:
+            length = MAX_PAGE_LENGTH
+        search = args.get("search[value]", "")
+
+        order_idx = _int_arg(args, "order[0][column]", 0)
+        if not 0 <= order_idx < len(self.columns):
+            order_idx = 0
+        descending = args.get("order[0][dir]") == "desc"
+        column = self.columns[order_idx]
+
+        n_total = self._count(self.query)
+        query = self._search(self.query, search)
+        n_filtered = self._count(query) if search else n_total
+
+        expression, key = column.expression, self.key
+        if descending:
+            expression, key = expression.desc(), key.desc()
+        query = query.order_by(expression, key)
+
+        state = [order_idx, descending, search]
+        cursor = None
+        try:
+            cursor = json.loads(args.get("after") or "null")
+        except ValueError:
+            pass
+        if (
+            not column.nullable
+            and isinstance(cursor, dict)
+            and cursor.get("state") == state
+            and cursor.get("start") == start
+            and len(cursor.get("key") or []) == 2
+        ):
+            query = query.filter(
+                self._after(column, descending, cursor["key"])
+            )
+        elif start:
+            query = query.offset(start)
+        rows = query.limit(length).all()
+
+        next_cursor = None
+        if rows and not column.nullable:
+            last = rows[-1]
+            next_cursor = json.dumps(
+                {
+                    "state": state,
+                    "start": start + len(rows),
+                    "key": [last[order_idx], last[-1]],
+                }
+            )
+        return {
+            "draw": draw,
+            "recordsTotal": n_total,
+            "recordsFiltered": n_filtered,
+            "data": [self.render(row) for row in rows],
+            "cursor": next_cursor,
+        }
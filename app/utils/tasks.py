@@ -8,46 +8,297 @@
 
 """
 
+import datetime
 import random
-import multiprocessing
 
 from flask import current_app
+from sqlalchemy import func, literal
+from sqlalchemy.exc import IntegrityError
 
-from app.models import Dataset, Task
+from app import db
+from app.models import Annotation, Dataset, Task, TaskEvent, User
 
-TASK_LOCK = multiprocessing.Lock()
+# Number of times we try to claim a task before giving up. A claim only fails
+# if another request changed the tasks of the user or of the selected dataset
+# in the meantime.
+TASK_CLAIM_ATTEMPTS = 5
 
 
-def generate_user_task(user):
-    task = None
-    TASK_LOCK.acquire(timeout=10)
+def update_task_count(dataset_id, delta):
+    """ Change the task counter of a dataset by delta in the database """
+    db.session.query(Dataset).filter(Dataset.id == dataset_id).update(
+        {Dataset.n_tasks: Dataset.n_tasks + delta}, synchronize_session=False
+    )
+
+
+def add_task(task):
+    """ Add a new task to the session and count it for its dataset """
+    db.session.add(task)
+    update_task_count(task.dataset_id, 1)
+
+
+def record_task_event(task_id, event):
+    """ Add an entry for a finished task to the task event log """
+    db.session.add(TaskEvent(task_id=task_id, event=event))
+
+
+def delete_task(task):
+    """Delete a task and its annotations and uncount it for its dataset
+
+    Deleting a finished task is recorded in the task event log, so that it
+    is also removed from the export snapshot, and in the annotation journal,
+    so that replaying the journal doesn't restore it.
+    """
+    # imported here because the journal uses the functions of this module
+    from app.utils.journal import journal_task_deletion
+
+    for ann in Annotation.query.filter_by(task_id=task.id).all():
+        db.session.delete(ann)
+    if task.done:
+        record_task_event(task.id, "deleted")
+        journal_task_deletion(task)
+    db.session.delete(task)
+    update_task_count(task.dataset_id, -1)
+
+
+def finish_task(task, changepoints, annotated_on=None):
+    """Replace the annotations of a task and mark it as done
+
+    changepoints is a list of change point indices, or None if the user
+    indicated that there are no change points (this is stored as a single
+    annotation with cp_index None). The previous annotations are removed and
+    the new ones added with a single bulk insert, and everything is committed
+    as one transaction, so a task is never left partially annotated.
+    """
+    if annotated_on is None:
+        annotated_on = datetime.datetime.utcnow()
+    if task.id is None:
+        db.session.flush()
+
+    if changepoints is None:
+        changepoints = [None]
+    rows = [{"cp_index": cp, "task_id": task.id} for cp in changepoints]
     try:
-        task = realgenerate_user_task(user)
-    finally:
-        TASK_LOCK.release()
-    return task
+        db.session.query(Annotation).filter(
+            Annotation.task_id == task.id
+        ).delete(synchronize_session=False)
+        if rows:
+            db.session.execute(Annotation.__table__.insert(), rows)
+        task.done = True
+        task.annotated_on = annotated_on
+        db.session.commit()
+    except:
+        db.session.rollback()
+        raise
+
 
+def rebuild_task_counts(dataset_ids=None):
+    """Recompute the task counters of datasets from the task table
 
-def realgenerate_user_task(user):
+    If dataset_ids is None the counters of all datasets are recomputed.
+    Returns the number of datasets whose counter was incorrect. The caller
+    must commit the transaction.
     """
-    Generate new task for a given user.
+    counts = (
+        db.session.query(func.count(Task.id))
+        .filter(Task.dataset_id == Dataset.id)
+        .as_scalar()
+    )
+    datasets = db.session.query(Dataset)
+    if not dataset_ids is None:
+        datasets = datasets.filter(Dataset.id.in_(dataset_ids))
+    n_stale = (
+        datasets.with_entities(func.count(Dataset.id))
+        .filter(Dataset.n_tasks != counts)
+        .scalar()
+    )
+    datasets.update({Dataset.n_tasks: counts}, synchronize_session=False)
+    return n_stale
+
+
+def lease_expiry(now=None):
+    """ Expiry time of a task lease that starts now """
+    if now is None:
+        now = datetime.datetime.utcnow()
+    duration = current_app.config["TASKS_LEASE_DURATION"]
+    return now + datetime.timedelta(seconds=duration)
+
+
+def renew_lease(task):
+    """ Extend the lease of an unfinished task, if it has one """
+    if task.done or task.lease_expires is None:
+        return
+    task.lease_expires = lease_expiry()
+
+
+def reap_expired_tasks(now=None):
+    """Release the unfinished tasks whose lease has expired
+
+    Only automatically assigned tasks have a lease, so tasks assigned by an
+    admin are never released. The tasks (and any stray annotations) are
+    deleted in bulk and the task counters of the affected datasets are
+    recomputed. Tasks that are finished while this runs are left alone.
+    Returns the number of released tasks. The caller must commit the
+    transaction.
+    """
+    if now is None:
+        now = datetime.datetime.utcnow()
+    expired = (
+        db.session.query(Task.id, Task.dataset_id)
+        .filter(Task.done == False, Task.lease_expires < now)
+        .all()
+    )
+    if not expired:
+        return 0
+
+    conditions = (
+        Task.id.in_([task_id for task_id, _ in expired]),
+        Task.done == False,
+        Task.lease_expires < now,
+    )
+    reaped = db.session.query(Task.id).filter(*conditions)
+    db.session.query(Annotation).filter(
+        Annotation.task_id.in_(reaped)
+    ).delete(synchronize_session=False)
+    n_reaped = (
+        db.session.query(Task)
+        .filter(*conditions)
+        .delete(synchronize_session=False)
+    )
+    rebuild_task_counts({dataset_id for _, dataset_id in expired})
+    return n_reaped
+
+
+def user_task_query(user):
+    """ Query for the non-demo tasks of a user """
+    return (
+        db.session.query(Task)
+        .join(Dataset, Task.dataset)
+        .filter(Task.annotator_id == user.id, Dataset.is_demo == False)
+    )
 
-    This function assigns tasks to a given user and ensures that:
+
+def get_unfinished_task(user):
+    """ Return an unfinished non-demo task of the user, or None """
+    return user_task_query(user).filter(Task.done == False).first()
+
+
+def generate_user_task(user):
+    """Assign a new task to the user and store it in the database
+
+    The dataset is selected by select_user_dataset and then claimed with a
+    single conditional INSERT ... SELECT that only inserts the task if the
+    user still has no unfinished task, is below the maximum number of tasks,
+    hasn't been given the dataset already, and the dataset hasn't received
+    more tasks since it was selected. This makes assignment safe across
+    worker processes and hosts sharing the database. On databases that
+    support it, the rows of the user and the dataset are locked first so that
+    concurrent claims are serialized instead of deadlocking.
+
+    Returns the new task, or None if no task could be assigned.
+    """
+    max_per_user = current_app.config["TASKS_MAX_PER_USER"]
+    num_per_dataset = current_app.config["TASKS_NUM_PER_DATASET"]
+
+    for _ in range(TASK_CLAIM_ATTEMPTS):
+        selected = select_user_dataset(user)
+        if selected is None:
+            return None
+        dataset_id, n_tasks = selected
+        if dataset_id is None:
+            # the counters changed while the dataset was selected
+            continue
+
+        # datasets that need annotations are never given more than
+        # num_per_dataset tasks, others at most one more than they have now.
+        max_tasks = max(num_per_dataset, n_tasks + 1)
+        try:
+            claimed = claim_task(user, dataset_id, max_tasks, max_per_user)
+        except IntegrityError:
+            # a concurrent claim gave the user this dataset
+            claimed = False
+        if claimed:
+            db.session.commit()
+            return Task.query.filter_by(
+                annotator_id=user.id, dataset_id=dataset_id
+            ).first()
+        db.session.rollback()
+    return None
+
+
+def claim_task(user, dataset_id, max_tasks, max_per_user):
+    """Insert a task for the user and dataset if the conditions still hold
+
+    Returns True if the task was inserted. The caller must commit or roll
+    back the transaction.
+    """
+    db.session.query(User.id).filter(User.id == user.id).with_for_update(
+        read=False
+    ).first()
+    db.session.query(Dataset.id).filter(
+        Dataset.id == dataset_id
+    ).with_for_update(read=False).first()
+
+    user_tasks = user_task_query(user).with_entities(Task.id)
+    n_user_tasks = user_tasks.with_entities(func.count(Task.id)).as_scalar()
+    has_dataset = (
+        db.session.query(Task.id)
+        .filter(Task.annotator_id == user.id, Task.dataset_id == dataset_id)
+        .exists()
+    )
+    source = db.session.query(
+        literal(user.id),
+        Dataset.id,
+        literal(False),
+        literal(False),
+        literal(lease_expiry()),
+    ).filter(
+        Dataset.id == dataset_id,
+        ~user_tasks.filter(Task.done == False).exists(),
+        ~has_dataset,
+        n_user_tasks < max_per_user,
+        Dataset.n_tasks < max_tasks,
+    )
+    insert = Task.__table__.insert().from_select(
+        [
+            "annotator_id",
+            "dataset_id",
+            "done",
+            "admin_assigned",
+            "lease_expires",
+        ],
+        source.statement,
+    )
+    result = db.session.execute(insert)
+    if not result.rowcount == 1:
+        return False
+    update_task_count(dataset_id, 1)
+    return True
+
+
+def select_user_dataset(user):
+    """
+    Select a dataset to assign to a given user.
+
+    This function selects datasets for a given user and ensures that:
 
         1) datasets that are nearly annotated with the desired number of 
         datasets get priority
         2) users never are given more tasks than max_per_user
         3) users never get the same dataset twice
 
+    Returns a tuple of the id of the dataset and its current number of tasks,
+    or None if no dataset should be assigned. The id is None if the task
+    counters changed during the selection.
     """
     max_per_user = current_app.config["TASKS_MAX_PER_USER"]
     num_per_dataset = current_app.config["TASKS_NUM_PER_DATASET"]
 
-    user_tasks = Task.query.filter_by(annotator_id=user.id).all()
-    user_tasks = [t for t in user_tasks if not t.dataset.is_demo]
+    # status of the non-demo tasks of the user
+    user_tasks = user_task_query(user).with_entities(Task.done).all()
 
     # don't assign a new task if the user has assigned tasks
-    not_done = [t for t in user_tasks if not t.done]
+    not_done = [done for done, in user_tasks if not done]
     if len(not_done) > 0:
         return None
 
@@ -56,51 +307,51 @@ def realgenerate_user_task(user):
     if n_user_tasks >= max_per_user:
         return None
 
-    # collect datasets that can be potentially assigned to the user
-    potential_datasets = []
-    for dataset in Dataset.query.filter_by(is_demo=False).all():
-        dataset_tasks = Task.query.filter_by(dataset_id=dataset.id).all()
-
-        # check that this dataset needs more annotations
-        n_needed = num_per_dataset - len(dataset_tasks)
-
-        # check that this dataset is not already assigned to the user
-        task = Task.query.filter_by(
-            dataset_id=dataset.id, annotator_id=user.id
-        ).first()
-        if not task is None:
-            continue
-        potential_datasets.append((n_needed, dataset))
+    # Count the datasets at every coverage level (number of tasks), leaving
+    # out those that are already assigned to the user. This only needs the
+    # index on Dataset.n_tasks, not the task table.
+    user_datasets = db.session.query(Task.dataset_id).filter(
+        Task.annotator_id == user.id
+    )
+    level_query = (
+        db.session.query(Dataset.n_tasks, func.count(Dataset.id))
+        .filter(Dataset.is_demo == False)
+        .group_by(Dataset.n_tasks)
+    )
+    levels = dict(level_query.all())
+    for n_tasks, count in level_query.filter(Dataset.id.in_(user_datasets)):
+        levels[n_tasks] = levels.get(n_tasks, 0) - count
+    levels = {n: count for n, count in levels.items() if count > 0}
 
     # don't assign a dataset if there are no more datasets to annotate (user
     # has done all)
-    if len(potential_datasets) == 0:
+    if len(levels) == 0:
         return None
 
     # First try assigning a random dataset that still needs annotations
-    dataset = None
-    need_annotations = [d for n, d in potential_datasets if n > 0]
+    need_annotations = [n for n in levels if n < num_per_dataset]
 
     # Weights are set to prioritize datasets that need fewer annotations to
     # reach our goal (num_per_dataset), with a small chance of selecting
-    # another dataset.
-    weights = [
-        (num_per_dataset - n + 0.01) for n, d in potential_datasets if n > 0
-    ]
+    # another dataset. All datasets at a level have the same weight, so we
+    # first select a level and then a dataset at that level.
+    weights = [levels[n] * (n + 0.01) for n in need_annotations]
     if need_annotations:
-        dataset = random.choices(need_annotations, weights=weights)[0]
+        n_tasks = random.choices(need_annotations, weights=weights)[0]
     else:
         # if there are no such datasets, then this user is requesting
         # additional annotations after all datasets have our desired coverage
         # of num_per_dataset. Assign a random dataset that has the least excess
         # annotations (thus causing even distribution).
-        max_nonpos = max((n for n, d in potential_datasets if n <= 0))
-        extra = [d for n, d in potential_datasets if n == max_nonpos]
-        if extra:
-            dataset = random.choice(extra)
-
-    if dataset is None:
-        return None
+        n_tasks = min(levels)
 
-    task = Task(annotator_id=user.id, dataset_id=dataset.id)
-    return task
+    dataset_id = (
+        db.session.query(Dataset.id)
+        .filter(Dataset.is_demo == False, Dataset.n_tasks == n_tasks)
+        .filter(~Dataset.id.in_(user_datasets))
+        .order_by(Dataset.id)
+        .offset(random.randrange(levels[n_tasks]))
+        .limit(1)
+        .scalar()
+    )
+    return dataset_id, n_tasks
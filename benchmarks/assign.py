@@ -0,0 +1,112 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Author: G.J.J. van den Burg <gvandenburg@turing.ac.uk>
+# License: See LICENSE file
+# Copyright: 2020 (c) The Alan Turing Institute
+
+"""Benchmark the task assignment behind /assign
+
+Fills an in-memory SQLite database with a growing number of datasets and 
+existing tasks, and reports the time and number of SQL queries needed to 
+generate a task for a user. Both should stay (nearly) flat as the number of 
+datasets grows.
+
+Run from the root of the repository:
+
+    python benchmarks/assign.py [--sizes 100 1000 10000 100000]
+
+"""
+
+import argparse
+import random
+import statistics
+import time
+
+from common import BenchmarkConfig, QueryCounter, add_datasets, add_users
+
+from app import create_app, db
+from app.models import Task, User
+from app.utils.tasks import generate_user_task
+
+
+class AssignConfig(BenchmarkConfig):
+    TASKS_MAX_PER_USER = 10 ** 9
+
+
+def populate(n_datasets, n_users, num_per_dataset):
+    add_users(n_users)
+    n_tasks = [random.randint(0, num_per_dataset) for _ in range(n_datasets)]
+    add_datasets(n_datasets, n_tasks)
+    tasks = []
+    user_ids = list(range(2, n_users + 1))
+    for dataset_id in range(1, n_datasets + 1):
+        k = n_tasks[dataset_id - 1]
+        for user_id in random.sample(user_ids, k):
+            tasks.append(
+                {
+                    "annotator_id": user_id,
+                    "dataset_id": dataset_id,
+                    "done": True,
+                    "admin_assigned": False,
+                }
+            )
+    db.session.execute(Task.__table__.insert(), tasks)
+    db.session.commit()
+
+
+def run(n_datasets, repeats):
+    app = create_app(AssignConfig)
+    with app.app_context():
+        db.create_all()
+        num_per_dataset = app.config["TASKS_NUM_PER_DATASET"]
+        populate(n_datasets, 50, num_per_dataset)
+
+        user = User.query.get(1)
+        timings = []
+        queries = []
+        for _ in range(repeats):
+            with QueryCounter(db.engine) as counter:
+                t_start = time.perf_counter()
+                task = generate_user_task(user)
+                task.done = True
+                db.session.commit()
+                timings.append(time.perf_counter() - t_start)
+            queries.append(counter.count)
+
+        db.session.remove()
+        db.drop_all()
+    return timings, queries
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument(
+        "--sizes",
+        type=int,
+        nargs="+",
+        default=[100, 1000, 10000, 100000],
+        help="Numbers of datasets to benchmark",
+    )
+    parser.add_argument(
+        "--repeats", type=int, default=20, help="Assignments per size"
+    )
+    args = parser.parse_args()
+
+    columns = ("datasets", "median (ms)", "max (ms)", "queries")
+    print("%10s %12s %12s %10s" % columns)
+    for n_datasets in args.sizes:
+        timings, queries = run(n_datasets, args.repeats)
+        print(
+            "%10i %12.2f %12.2f %10i"
+            % (
+                n_datasets,
+                1000 * statistics.median(timings),
+                1000 * max(timings),
+                max(queries),
+            )
+        )
+
+
+if __name__ == "__main__":
+    main()
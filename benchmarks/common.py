@@ -0,0 +1,92 @@
+# -*- coding: utf-8 -*-
+
+# Author: G.J.J. van den Burg <gvandenburg@turing.ac.uk>
+# License: See LICENSE file
+# Copyright: 2020 (c) The Alan Turing Institute
+
+"""Shared helpers for the benchmarks
+
+"""
+
+import math
+import os
+import sys
+
+sys.path.insert(
+    0, os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+)
+
+from sqlalchemy import event
+
+from app import db
+from app.models import Dataset, User
+from config import Config
+
+
+class BenchmarkConfig(Config):
+    SQLALCHEMY_DATABASE_URI = "sqlite://"
+    WTF_CSRF_ENABLED = False
+    MAIL_SUPPRESS_SEND = True
+    ADMINS = ["admin@example.com"]
+
+
+class QueryCounter(object):
+    """ Count the SQL statements executed on an engine """
+
+    def __init__(self, engine):
+        self.engine = engine
+        self.count = 0
+
+    def __enter__(self):
+        event.listen(self.engine, "before_cursor_execute", self._count)
+        return self
+
+    def __exit__(self, *args):
+        event.remove(self.engine, "before_cursor_execute", self._count)
+
+    def _count(self, *args):
+        self.count += 1
+
+
+def add_users(n_users):
+    """ Add confirmed and introduced users with ids 1 to n_users """
+    db.session.execute(
+        User.__table__.insert(),
+        [
+            {
+                "username": "user%i" % i,
+                "email": "user%i@example.com" % i,
+                "password_hash": "x",
+                "is_confirmed": True,
+                "is_introduced": True,
+            }
+            for i in range(n_users)
+        ],
+    )
+
+
+def add_datasets(n_datasets, n_tasks=None):
+    """ Add non-demo datasets with ids 1 to n_datasets """
+    if n_tasks is None:
+        n_tasks = [0] * n_datasets
+    db.session.execute(
+        Dataset.__table__.insert(),
+        [
+            {
+                "name": "dataset%i" % i,
+                "md5sum": "%032x" % i,
+                "is_demo": False,
+                "n_tasks": n_tasks[i],
+            }
+            for i in range(n_datasets)
+        ],
+    )
+
+
+def percentile(values, q):
+    """ Nearest-rank percentile (0 < q <= 100) of a list of numbers """
+    values = sorted(values)
+    if not values:
+        return float("nan")
+    rank = max(1, math.ceil(q / 100 * len(values)))
+    return values[rank - 1]
@@ -0,0 +1,139 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Author: G.J.J. van den Burg <gvandenburg@turing.ac.uk>
+# License: See LICENSE file
+# Copyright: 2020 (c) The Alan Turing Institute
+
+"""Check that the frequent task and annotation queries use an index
+
+Runs EXPLAIN for the queries behind the index page, /assign, the annotation 
+page and the admin views, and exits with a non-zero status if any of them 
+scans the full task or annotation table. By default this uses an in-memory 
+SQLite database created from the models. To check a MySQL database, pass its 
+URI (the database must be migrated to the latest version, and should contain 
+a realistic amount of data, as MySQL prefers full scans of small tables):
+
+    python benchmarks/query_plans.py --database-uri mysql+pymysql://...
+
+"""
+
+import argparse
+import re
+import sys
+
+from common import BenchmarkConfig, add_datasets, add_users
+
+from sqlalchemy import func, text
+
+from app import create_app, db
+from app.models import Annotation, Dataset, Task
+from app.utils.tasks import user_task_query
+
+CHECKED_TABLES = ("task", "annotation")
+
+
+class _User(object):
+    id = 1
+
+
+def hot_queries():
+    user = _User()
+    return {
+        "unfinished user task": user_task_query(user).filter(
+            Task.done == False
+        ),
+        "tasks of user": Task.query.filter_by(annotator_id=user.id),
+        "task of user for dataset": Task.query.filter_by(
+            annotator_id=user.id, dataset_id=1
+        ),
+        "tasks of dataset": Task.query.filter_by(dataset_id=1),
+        "finished tasks of dataset": db.session.query(
+            func.count(Task.id)
+        ).filter(Task.dataset_id == 1, Task.done == True),
+        "annotations of task": Annotation.query.filter_by(task_id=1),
+        "annotations of dataset": Annotation.query.join(
+            Task, Annotation.task
+        ).filter(Task.dataset_id == 1),
+        "coverage levels": db.session.query(
+            Dataset.n_tasks, func.count(Dataset.id)
+        )
+        .filter(Dataset.is_demo == False)
+        .group_by(Dataset.n_tasks),
+    }
+
+
+def compile_query(query):
+    return str(
+        query.statement.compile(
+            dialect=db.engine.dialect, compile_kwargs={"literal_binds": True}
+        )
+    )
+
+
+def full_scans_sqlite(sql):
+    rows = db.session.execute(text("EXPLAIN QUERY PLAN " + sql)).fetchall()
+    details = [row[-1] for row in rows]
+    pattern = r"^SCAN (TABLE )?(%s)( AS \w+)?$" % "|".join(CHECKED_TABLES)
+    return details, [d for d in details if re.match(pattern, d)]
+
+
+def full_scans_mysql(sql):
+    result = db.session.execute(text("EXPLAIN " + sql))
+    rows = [dict(zip(result.keys(), row)) for row in result.fetchall()]
+    details = [
+        "%s: type=%s key=%s" % (r["table"], r["type"], r["key"]) for r in rows
+    ]
+    scans = [
+        d
+        for r, d in zip(rows, details)
+        if r["table"] in CHECKED_TABLES and r["type"] == "ALL"
+    ]
+    return details, scans
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument(
+        "--database-uri", help="Database to check (default: SQLite in memory)"
+    )
+    parser.add_argument("-v", "--verbose", action="store_true")
+    args = parser.parse_args()
+
+    class PlanConfig(BenchmarkConfig):
+        if args.database_uri:
+            SQLALCHEMY_DATABASE_URI = args.database_uri
+
+    app = create_app(PlanConfig)
+    failed = False
+    with app.app_context():
+        if not args.database_uri:
+            db.create_all()
+            add_users(10)
+            add_datasets(100)
+            db.session.commit()
+
+        dialect = db.engine.dialect.name
+        if dialect == "sqlite":
+            full_scans = full_scans_sqlite
+        elif dialect == "mysql":
+            full_scans = full_scans_mysql
+        else:
+            print("Unsupported database: %s" % dialect)
+            sys.exit(2)
+
+        for name, query in hot_queries().items():
+            details, scans = full_scans(compile_query(query))
+            status = "FULL SCAN" if scans else "ok"
+            failed = failed or bool(scans)
+            print("%-28s %s" % (name, status))
+            if args.verbose or scans:
+                for detail in details:
+                    print("    %s" % detail)
+
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,229 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Author: G.J.J. van den Burg <gvandenburg@turing.ac.uk>
+# License: See LICENSE file
+# Copyright: 2020 (c) The Alan Turing Institute
+
+"""Simulate annotators to benchmark the task assignment policy
+
+Builds an in-memory SQLite database with the given number of users and 
+datasets and drives simulated annotators through /assign and /annotate using 
+the Flask test client. An annotator that receives a task either submits an 
+annotation or, with probability --abandon, leaves for good without finishing 
+it (its task is released when the lease expires).
+
+Reports the latency (p50/p99) and number of SQL queries per request for each 
+endpoint, and how the coverage of the datasets converges. With --max-p99 
+and/or --max-queries the script exits with a non-zero status when these 
+limits are exceeded, so it can be used as a regression check for changes to 
+task assignment.
+
+Run from the root of the repository:
+
+    python benchmarks/simulate.py --users 1000 --datasets 500 --steps 5000
+
+"""
+
+import argparse
+import collections
+import random
+import sys
+import time
+
+from common import (
+    BenchmarkConfig,
+    QueryCounter,
+    add_datasets,
+    add_users,
+    percentile,
+)
+
+from sqlalchemy import func
+
+from app import create_app, db
+from app.models import Dataset, Task
+
+
+def make_config(args):
+    class SimulationConfig(BenchmarkConfig):
+        TESTING = True
+        TASKS_MAX_PER_USER = args.max_per_user
+        TASKS_NUM_PER_DATASET = args.num_per_dataset
+        TASKS_LEASE_DURATION = args.lease
+
+    return SimulationConfig
+
+
+def login(client, user_id):
+    with client.session_transaction() as session:
+        # key used by Flask-Login < 0.5 and >= 0.5, respectively
+        session["user_id"] = str(user_id)
+        session["_user_id"] = str(user_id)
+        session["_fresh"] = True
+
+
+def coverage(num_per_dataset):
+    """ Summarize the number of finished tasks per dataset """
+    done = dict(
+        db.session.query(Task.dataset_id, func.count(Task.id))
+        .filter(Task.done == True)
+        .group_by(Task.dataset_id)
+        .all()
+    )
+    n_datasets = db.session.query(func.count(Dataset.id)).scalar()
+    counts = [done.get(i, 0) for i in range(1, n_datasets + 1)]
+    complete = sum(c >= num_per_dataset for c in counts)
+    return {
+        "complete": 100 * complete / n_datasets,
+        "mean": sum(counts) / n_datasets,
+        "min": min(counts),
+        "max": max(counts),
+    }
+
+
+def simulate(args):
+    random.seed(args.seed)
+    app = create_app(make_config(args))
+    timings = collections.defaultdict(list)
+    queries = collections.defaultdict(list)
+    history = []
+
+    with app.app_context():
+        db.create_all()
+        add_users(args.users)
+        add_datasets(args.datasets)
+        db.session.commit()
+        engine = db.engine
+
+    def request(endpoint, method, *a, **kw):
+        with QueryCounter(engine) as counter:
+            t_start = time.perf_counter()
+            response = method(*a, **kw)
+            timings[endpoint].append(time.perf_counter() - t_start)
+        queries[endpoint].append(counter.count)
+        return response
+
+    def report(step):
+        with app.app_context():
+            history.append((step, coverage(args.num_per_dataset)))
+
+    # Requests are made outside of an application context, otherwise every
+    # request would share it (and with it the logged in user and session).
+    clients = {}
+    active = list(range(1, args.users + 1))
+    for step in range(1, args.steps + 1):
+        if not active:
+            break
+        user_id = random.choice(active)
+        if not user_id in clients:
+            clients[user_id] = app.test_client()
+            login(clients[user_id], user_id)
+        client = clients[user_id]
+
+        response = request("/assign", client.get, "/assign")
+        location = response.headers.get("Location", "")
+        if not "/annotate/" in location:
+            # no more tasks for this user
+            active.remove(user_id)
+        elif random.random() < args.abandon:
+            active.remove(user_id)
+        else:
+            task_id = int(location.rstrip("/").split("/")[-1])
+            n_cps = random.choice([0, 1, 2])
+            changepoints = [
+                {"id": i, "x": random.randrange(100)} for i in range(n_cps)
+            ]
+            annotation = {
+                "identifier": task_id,
+                "changepoints": changepoints if n_cps else None,
+            }
+            request(
+                "/annotate",
+                client.post,
+                "/annotate/%i" % task_id,
+                json=annotation,
+            )
+
+        if step % args.report_every == 0:
+            report(step)
+    if not history or history[-1][0] != step:
+        report(step)
+    return timings, queries, history
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--users", type=int, default=1000)
+    parser.add_argument("--datasets", type=int, default=500)
+    parser.add_argument("--max-per-user", type=int, default=50)
+    parser.add_argument("--num-per-dataset", type=int, default=5)
+    parser.add_argument(
+        "--steps", type=int, default=5000, help="Number of /assign requests"
+    )
+    parser.add_argument(
+        "--abandon",
+        type=float,
+        default=0.05,
+        help="Probability that an annotator leaves without finishing a task",
+    )
+    parser.add_argument(
+        "--lease", type=int, default=1, help="Task lease duration (seconds)"
+    )
+    parser.add_argument("--report-every", type=int, default=500)
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument(
+        "--max-p99", type=float, help="Fail if any p99 latency exceeds this (ms)"
+    )
+    parser.add_argument(
+        "--max-queries",
+        type=int,
+        help="Fail if any request uses more SQL queries than this",
+    )
+    args = parser.parse_args()
+
+    timings, queries, history = simulate(args)
+
+    print(
+        "%-10s %8s %10s %10s %10s %10s"
+        % ("endpoint", "requests", "p50 (ms)", "p99 (ms)", "queries", "max q")
+    )
+    failed = False
+    for endpoint in sorted(timings):
+        p50 = 1000 * percentile(timings[endpoint], 50)
+        p99 = 1000 * percentile(timings[endpoint], 99)
+        n_queries = queries[endpoint]
+        print(
+            "%-10s %8i %10.2f %10.2f %10.1f %10i"
+            % (
+                endpoint,
+                len(n_queries),
+                p50,
+                p99,
+                sum(n_queries) / len(n_queries),
+                max(n_queries),
+            )
+        )
+        if not args.max_p99 is None and p99 > args.max_p99:
+            failed = True
+        if not args.max_queries is None and max(n_queries) > args.max_queries:
+            failed = True
+
+    print()
+    print(
+        "%8s %12s %10s %6s %6s"
+        % ("step", "complete (%)", "mean", "min", "max")
+    )
+    for step, cov in history:
+        print(
+            "%8i %12.1f %10.2f %6i %6i"
+            % (step, cov["complete"], cov["mean"], cov["min"], cov["max"])
+        )
+
+    if failed:
+        print("\nRegression limits exceeded.")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -47,14 +47,76 @@ class Config(object):
         if x.strip()
     ]
 
+    # mail is sent by a background worker from a queue of this size, callers
+    # wait at most MAIL_QUEUE_TIMEOUT seconds for room in the queue. The SMTP
+    # connection is closed after MAIL_IDLE_TIMEOUT seconds without mail.
+    MAIL_QUEUE_SIZE = int(os.environ.get("MAIL_QUEUE_SIZE") or 1000)
+    MAIL_QUEUE_TIMEOUT = float(os.environ.get("MAIL_QUEUE_TIMEOUT") or 5)
+    MAIL_IDLE_TIMEOUT = float(os.environ.get("MAIL_IDLE_TIMEOUT") or 30)
+    MAIL_SEND_RETRIES = int(os.environ.get("MAIL_SEND_RETRIES") or 3)
+
+    # annotation backups are sent as digests of at most MAIL_DIGEST_SIZE
+    # records, at most MAIL_DIGEST_INTERVAL seconds after the first record.
+    MAIL_DIGEST_SIZE = int(os.environ.get("MAIL_DIGEST_SIZE") or 25)
+    MAIL_DIGEST_INTERVAL = float(os.environ.get("MAIL_DIGEST_INTERVAL") or 60)
+
+    # how recorded annotations are backed up: "email" and/or "journal"
+    # (semicolon separated). The journal is an append-only JSONL file in
+    # JOURNAL_DIR that is rotated when it exceeds JOURNAL_MAX_BYTES. Writers
+    # wait JOURNAL_COMMIT_DELAY seconds to share an fsync with others.
+    ANNOTATION_BACKUP = [
+        x.strip()
+        for x in (os.environ.get("ANNOTATION_BACKUP") or "email").split(";")
+        if x.strip()
+    ]
+    JOURNAL_MAX_BYTES = int(
+        os.environ.get("JOURNAL_MAX_BYTES") or 64 * 1024 * 1024
+    )
+    JOURNAL_COMMIT_DELAY = float(
+        os.environ.get("JOURNAL_COMMIT_DELAY") or 0.002
+    )
+
     # these should be used relative to the instance path
     DATASET_DIR = "datasets"
     TEMP_DIR = "tmp"
+    JOURNAL_DIR = "journal"
+    EXPORT_DIR = "exports"
+
+    # the export snapshot only treats tasks annotated more than this many
+    # seconds ago as final (see app.utils.snapshot)
+    EXPORT_SNAPSHOT_LAG = int(os.environ.get("EXPORT_SNAPSHOT_LAG") or 300)
+
+    # cached exports are removed this many seconds after a newer export
+    # replaced them, so that downloads in progress can finish
+    EXPORT_GRACE_PERIOD = int(os.environ.get("EXPORT_GRACE_PERIOD") or 3600)
+
+    # dataset integrity checks: with "stat" the md5sum is only recomputed when
+    # the size/mtime/inode of the file changed or when the last full check is
+    # older than DATASET_SCRUB_INTERVAL seconds (0 disables scrubbing). With
+    # "md5" the file is hashed every time it is read from disk.
+    DATASET_VERIFY = os.environ.get("DATASET_VERIFY") or "stat"
+    DATASET_SCRUB_INTERVAL = int(
+        os.environ.get("DATASET_SCRUB_INTERVAL") or 24 * 60 * 60
+    )
+
+    # univariate series longer than this are shown as a downsampled overview
+    # on the annotation page, with finer tiles loaded when zooming in.
+    CHART_MAX_POINTS = int(os.environ.get("CHART_MAX_POINTS") or 5000)
 
     # task distribution settings
     TASKS_MAX_PER_USER = int(os.environ.get("TASKS_MAX_PER_USER") or 50)
     TASKS_NUM_PER_DATASET = int(os.environ.get("TASKS_NUM_PER_DATASET") or 5)
 
+    # automatically assigned tasks are released when they haven't been
+    # finished within this many seconds after the user last opened them.
+    TASKS_LEASE_DURATION = int(
+        os.environ.get("TASKS_LEASE_DURATION") or 2 * 60 * 60
+    )
+
+    # whether to assign the next task when an annotation is submitted, so the
+    # user goes straight to the next dataset instead of via the home page.
+    TASKS_PREASSIGN = bool(int(os.environ.get("TASKS_PREASSIGN", 0)))
+
     # user emails allowed
     USER_EMAIL_DOMAINS = os.environ.get("USER_EMAIL_DOMAINS") or ""
     USER_EMAIL_DOMAINS = [
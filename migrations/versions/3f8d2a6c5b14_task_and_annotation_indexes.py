@@ -0,0 +1,82 @@
+"""task and annotation indexes
+
+Revision ID: 3f8d2a6c5b14
+Revises: e2b7a4d91c35
+Create Date: 2026-10-18 13:40:08.271946
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '3f8d2a6c5b14'
+down_revision = 'e2b7a4d91c35'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # Users could previously get multiple tasks for the same dataset by
+    # repeating the introduction. These have to be removed before adding the
+    # unique index. For every (user, dataset) we keep the finished task that
+    # was annotated last (the one used for the demo performance), or the most
+    # recent task if none of them are finished, so no finished annotations
+    # are lost in favour of an unfinished task.
+    conn = op.get_bind()
+    rows = conn.execute(
+        sa.text(
+            'SELECT t.id, t.annotator_id, t.dataset_id, t.done, t.annotated_on '
+            'FROM task t JOIN ('
+            'SELECT annotator_id, dataset_id FROM task '
+            'GROUP BY annotator_id, dataset_id HAVING COUNT(id) > 1'
+            ') p ON p.annotator_id = t.annotator_id '
+            'AND p.dataset_id = t.dataset_id'
+        )
+    )
+    groups = {}
+    for task_id, annotator_id, dataset_id, done, annotated_on in rows:
+        groups.setdefault((annotator_id, dataset_id), []).append(
+            (task_id, bool(done), annotated_on)
+        )
+
+    def preference(row):
+        # annotated_on is only compared between finished tasks that have
+        # one, the other rows are ordered by id
+        task_id, done, annotated_on = row
+        if done and not annotated_on is None:
+            return (2, annotated_on, task_id)
+        return (1 if done else 0, None, task_id)
+
+    duplicates = []
+    for group in groups.values():
+        keep = max(group, key=preference)
+        duplicates.extend(row[0] for row in group if not row is keep)
+
+    task = sa.table('task', sa.column('id', sa.Integer()))
+    annotation = sa.table('annotation', sa.column('task_id', sa.Integer()))
+    for i in range(0, len(duplicates), 500):
+        chunk = duplicates[i : i + 500]
+        op.execute(annotation.delete().where(annotation.c.task_id.in_(chunk)))
+        op.execute(task.delete().where(task.c.id.in_(chunk)))
+    if duplicates:
+        op.execute(
+            'UPDATE dataset SET n_tasks = '
+            '(SELECT COUNT(task.id) FROM task WHERE task.dataset_id = dataset.id)'
+        )
+
+    # ### commands auto generated by Alembic - please adjust! ###
+    op.create_index(op.f('ix_annotation_task_id'), 'annotation', ['task_id'], unique=False)
+    op.create_index('ix_task_annotator_id_dataset_id', 'task', ['annotator_id', 'dataset_id'], unique=True)
+    op.create_index('ix_task_annotator_id_done', 'task', ['annotator_id', 'done'], unique=False)
+    op.create_index('ix_task_dataset_id_done', 'task', ['dataset_id', 'done'], unique=False)
+    # ### end Alembic commands ###
+
+
+def downgrade():
+    # ### commands auto generated by Alembic - please adjust! ###
+    op.drop_index('ix_task_dataset_id_done', table_name='task')
+    op.drop_index('ix_task_annotator_id_done', table_name='task')
+    op.drop_index('ix_task_annotator_id_dataset_id', table_name='task')
+    op.drop_index(op.f('ix_annotation_task_id'), table_name='annotation')
+    # ### end Alembic commands ###